@@ -2,22 +2,26 @@
 Demonstration of learning how to play a VGDL game, when full state information is available (MDP) 
 and we have access to a model of the dynamics (transition probabilities).
 
-We use policy iteration as implemented in PyBrain.
+We use the sparse value iteration from vgdl.solvers.
 
 @author: Tom Schaul
 '''
 
 
 import pylab
-from pybrain.rl.learners.modelbased import policyIteration, trueValues
 
 from vgdl.mdpmap import MDPconverter
+from vgdl.mdpcache import MDPcache
+from vgdl.solvers import valueIteration
 from vgdl.core import VGDLParser
 from vgdl.plotting import featurePlot
 
 
 from matplotlib import rc
 rc('text', usetex=False)
+
+# converted MDPs are reused across runs
+cache = MDPcache()
     
 def plotOptimalValues(gametype, layout, discountFactor=0.9, showValue=False):
     # build the game
@@ -25,14 +29,11 @@ def plotOptimalValues(gametype, layout, discountFactor=0.9, showValue=False):
     g.buildLevel(layout)
     
     # transform into an MDP
-    C = MDPconverter(g)
+    C = MDPconverter(g, cache=cache)
     Ts, R, _ = C.convert()
     
-    # find the optimal policy
-    _, Topt = policyIteration(Ts, R, discountFactor=discountFactor)
-    
-    # evaluate the policy
-    Vopt = trueValues(Topt, R, discountFactor=discountFactor)
+    # find the optimal policy, and its values
+    Vopt, _, _ = valueIteration(Ts, R, discountFactor=discountFactor)
         
     # plot those values    
     featurePlot((g.width, g.height), C.states, Vopt, plotdirections=True)
@@ -81,7 +82,7 @@ def test4():
     g.buildLevel(windy_level)
     env = GameEnvironment(g, visualize=True, actionDelay=100)
     task = GameTask(env)
-    agent = PolicyDrivenAgent.buildOptimal(env)
+    agent = PolicyDrivenAgent.buildOptimal(env, cache=cache)
     exper = EpisodicExperiment(task, agent)
     res = exper.doEpisodes(5)
     print res
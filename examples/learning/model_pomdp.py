@@ -13,9 +13,12 @@ import pylab
 from pybrain.rl.learners.modelbased import LSPI_policy, trueValues, LSTD_PI_policy
 
 from vgdl.mdpmap import MDPconverter
+from vgdl.mdpcache import MDPcache
 from vgdl.core import VGDLParser
 from vgdl.plotting import featurePlot
 
+# converted MDPs are reused across runs
+cache = MDPcache()
 
 
 def plotLSPIValues(gametype, layout, discountFactor=0.9, useTD=False, showValue=False):
@@ -24,8 +27,8 @@ def plotLSPIValues(gametype, layout, discountFactor=0.9, useTD=False, showValue=
     g.buildLevel(layout)
     
     # transform into an MDP and the mapping to observations
-    C = MDPconverter(g)
-    Ts, R, fMap = C.convert()    
+    C = MDPconverter(g, cache=cache)
+    Ts, R, fMap = C.convert(dense=True)
     
     # find the the best least-squares approximation to the policy,
     # given only observations, not the state information
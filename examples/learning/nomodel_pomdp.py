@@ -93,15 +93,13 @@ def test1():
             print
 
 
-def plotBackground(env, known=[[]]):
-    if len(known[0]) == 0:
-        from vgdl.mdpmap import MDPconverter
-        g = env._game
-        C = MDPconverter(g, env=env, verbose=False)
-        _, R, _ = C.convert()
-        size = (g.width, g.height)
-        known[0].append((size, C.states, R))
-    featurePlot(*known[0][0])
+def plotBackground(env):
+    from vgdl.mdpmap import MDPconverter
+    from vgdl.mdpcache import MDPcache
+    g = env._game
+    C = MDPconverter(g, env=env, verbose=False, cache=MDPcache())
+    _, R = C.convert(observations=False)
+    featurePlot((g.width, g.height), C.states, R)
     
     
 def plotTrajectories(env, net, num_traj=5):
@@ -29,7 +29,8 @@
 
 Provides functionality for reading and writing animated GIF images.
 Use writeGif to write a series of numpy arrays or PIL images as an 
-animated GIF. Use readGif to read an animated gif as a series of numpy
+animated GIF, or a GifStreamWriter to write the frames one at a time
+as they come. Use readGif to read an animated gif as a series of numpy
 arrays.
 
 Note that since July 2004, all patents on the LZW compression patent have
@@ -68,9 +69,12 @@ Useful links
 import os, time
 
 try:
-    import Image
+    try:
+        import Image
+    except ImportError:
+        from PIL import Image
     PIL = Image
-    from PIL.GifImagePlugin import getheader, getdata
+    from PIL.GifImagePlugin import getdata
 except ImportError:
     PIL = None
 
@@ -134,6 +138,139 @@ def checkImages(images):
     return images2
 
 
+def getPalette(im):
+    """ getPalette(im)
+    The 256-color RGB palette of a paletted image, as a string (like the
+    second element of the old PIL getheader, which changed in Pillow).
+    """
+    pal = im.getpalette()
+    if pal is None:
+        # greyscale
+        return ''.join(chr(i) * 3 for i in range(256))
+    pal = pal[:768]
+    return np.array(pal, np.uint8).tostring() + '\x00' * (768 - len(pal))
+
+
+def rgbArray(im):
+    """ rgbArray(im)
+    An (H, W, 3) uint8 array of a numpy image (greyscale, RGB or RGBA).
+    """
+    if im.ndim == 2:
+        im = np.dstack([im, im, im])
+    return np.ascontiguousarray(im[:, :, :3])
+
+
+def colorKeys(im):
+    """ colorKeys(im)
+    One integer per pixel of a numpy image, encoding its RGB color
+    (red in the lowest byte).
+    """
+    im = rgbArray(im).reshape(-1, 3)
+    res = np.zeros((len(im), 4), np.uint8)
+    res[:, :3] = im
+    return res.view('<u4').ravel()
+
+
+def keysToColors(keys):
+    """ keysToColors(keys)
+    The RGB colors (N, 3) of color keys.
+    """
+    return np.column_stack([keys & 255, (keys >> 8) & 255, keys >> 16])
+
+
+def nearestColors(colors, palette, chunk=4096):
+    """ nearestColors(colors, palette)
+    For each of the RGB colors (N, 3), the index of the closest palette color.
+    """
+    colors = np.asarray(colors, np.int32)
+    palette = np.asarray(palette, np.int32)
+    res = np.empty(len(colors), np.uint8)
+    # in chunks, to bound the memory of the distance matrix
+    for i in range(0, len(colors), chunk):
+        d = colors[i:i + chunk, None, :] - palette[None, :, :]
+        res[i:i + chunk] = (d * d).sum(2).argmin(1)
+    return res
+
+
+def paletteIndices(im, palette):
+    """ paletteIndices(im, palette)
+    Map a numpy image onto a palette of at most 256 RGB colors, vectorized:
+    the pixels are looked up in the sorted palette, and the closest palette
+    color is searched only for the (distinct) colors that are not in it.
+    Returns a (H, W) uint8 array of palette indices.
+    """
+    keys = colorKeys(im)
+    palKeys = colorKeys(np.asarray(palette, np.uint8).reshape(-1, 1, 3))
+    order = np.argsort(palKeys)
+    pos = np.searchsorted(palKeys[order], keys).clip(0, len(order) - 1)
+    res = order[pos].astype(np.uint8)
+    missing = palKeys[res] != keys
+    if missing.any():
+        uniq, inverse = np.unique(keys[missing], return_inverse=True)
+        colors = keysToColors(uniq)
+        cKDTree = get_cKDTree()
+        if cKDTree is not None and len(colors) > 4096:
+            nearest = cKDTree(np.asarray(palette)[:, :3]).query(colors)[1]
+        else:
+            nearest = nearestColors(colors, palette)
+        res[missing] = nearest[inverse]
+    return res.reshape(im.shape[:2])
+
+
+def paletteList(palette):
+    """ paletteList(palette)
+    The flat list of 768 values that PIL's putpalette expects.
+    """
+    pal = [int(c) for color in palette for c in color[:3]]
+    return pal + [0] * (768 - len(pal))
+
+
+def paletteImage(palette):
+    """ paletteImage(palette)
+    A paletted PIL image with the given palette, for Image.quantize.
+    """
+    im = Image.new('P', (1, 1), 0)
+    im.putpalette(paletteList(palette))
+    return im
+
+
+def getGlobalPalette(images, nq=0, maxSample=2**16):
+    """ getGlobalPalette(images, nq=0, maxSample=2**16)
+    One palette for all the images (numpy arrays or PIL images): their
+    colors if there are at most 256 of them (as in typical game frames),
+    otherwise one quantization of a sample of their pixels (with NeuQuant
+    if nq is nonzero, and the adaptive PIL algorithm otherwise).
+    """
+    arrays = []
+    for im in images:
+        if PIL and isinstance(im, PIL.Image):
+            im = np.asarray(im.convert('RGB'))
+        arrays.append(rgbArray(im))
+    
+    # The colors of all images, as long as there are few
+    seen = np.zeros(1 << 24, bool)
+    count = 0
+    for im in arrays:
+        keys = colorKeys(im)
+        new = keys[~seen[keys]]
+        if len(new) > 0:
+            seen[new] = True
+            count += len(np.unique(new))
+            if count > 256:
+                break
+    else:
+        return keysToColors(np.flatnonzero(seen)).astype(np.uint8)
+    
+    # Otherwise quantize a sample of the pixels, as one image
+    pixels = np.concatenate([im.reshape(-1, 3) for im in arrays])
+    sample = pixels[::max(1, len(pixels) // maxSample)]
+    sample = Image.fromarray(np.ascontiguousarray(sample).reshape(-1, 1, 3), 'RGB')
+    if nq >= 1:
+        return NeuQuant(sample.convert('RGBA'), int(nq)).colormap[:, :3].astype(np.uint8)
+    pal = sample.convert('P', palette=Image.ADAPTIVE).getpalette()[:768]
+    return np.array(pal, np.uint8).reshape(-1, 3)
+
+
 def intToBin(i):
     """ Integer to two bytes """
     # divide in two parts (bytes)
@@ -163,8 +300,8 @@ class GifWriter:
         return bb
     
     
-    def getImageDescriptor(self, im, xy=None):
-        """ getImageDescriptor(im, xy=None)
+    def getImageDescriptor(self, im, xy=None, localPalette=True):
+        """ getImageDescriptor(im, xy=None, localPalette=True)
         
         Used for the local color table properties per image.
         Otherwise global color table applies to all frames irrespective of
@@ -191,7 +328,10 @@ class GifWriter:
         
         # packed field: local color table flag1, interlace0, sorted table0, 
         # reserved00, lct size111=7=2^(7+1)=256.
-        bb += '\x87' 
+        if localPalette:
+            bb += '\x87' 
+        else:
+            bb += '\x00'
         
         # LZW minimum size code now comes later, begining of [image data] blocks
         return bb
@@ -298,6 +438,39 @@ class GifWriter:
         return images, xy
     
     
+    def getDiffRectangle(self, prev, im):
+        """ getDiffRectangle(prev, im)
+        
+        The minimal rectangle (x0, x1, y0, y1) that contains all pixels
+        of the numpy image im that differ from those of prev, but at least
+        2x2 pixels (PIL encodes images that are 1 pixel wide wrongly).
+        If nothing changed, a minimal rectangle at the upper left.
+        
+        """
+        
+        # Pixels that differ in any channel, then the rows and columns
+        # that contain any of them
+        changed = im != prev
+        if changed.ndim == 3:
+            changed = changed.any(2)
+        X = np.flatnonzero(changed.any(0))
+        Y = np.flatnonzero(changed.any(1))
+        if not X.size: # No change ... make it minimal
+            return 0, 2, 0, 2
+        
+        # Grow a rectangle that is too thin, within the image
+        H, W = changed.shape
+        x0, x1 = int(X[0]), int(X[-1])+1
+        y0, y1 = int(Y[0]), int(Y[-1])+1
+        if x1 - x0 < 2:
+            x0 = max(0, min(x0, W-2))
+            x1 = x0 + 2
+        if y1 - y0 < 2:
+            y0 = max(0, min(y0, H-2))
+            y1 = y0 + 2
+        return x0, x1, y0, y1
+    
+    
     def getSubRectangles(self, ims):
         """ getSubRectangles(ims)
         
@@ -327,21 +500,7 @@ class GifWriter:
         # Iterate over images
         prev = ims[0]
         for im in ims[1:]:
-            
-            # Get difference, sum over colors
-            diff = np.abs(im-prev)
-            if diff.ndim==3:
-                diff = diff.sum(2)  
-            # Get begin and end for both dimensions
-            X = np.argwhere(diff.sum(0))
-            Y = np.argwhere(diff.sum(1))
-            # Get rect coordinates
-            if X.size and Y.size:
-                x0, x1 = X[0], X[-1]+1
-                y0, y1 = Y[0], Y[-1]+1
-            else: # No change ... make it minimal
-                x0, x1 = 0, 2
-                y0, y1 = 0, 2
+            x0, x1, y0, y1 = self.getDiffRectangle(prev, im)
             
             # Cut out and store
             im2 = im[y0:y1,x0:x1]
@@ -355,14 +514,31 @@ class GifWriter:
         return ims2, xy
     
     
-    def convertImagesToPIL(self, images, dither, nq=0):
-        """ convertImagesToPIL(images, nq=0)
+    def convertImagesToPIL(self, images, dither, nq=0, palette=None):
+        """ convertImagesToPIL(images, nq=0, palette=None)
         
         Convert images to Paletted PIL images, which can then be 
-        written to a single animated GIF.
+        written to a single animated GIF. If a palette (an array of at
+        most 256 RGB colors) is given, all images use it.
         
         """
         
+        if palette is not None:
+            palList = paletteList(palette)
+            palImage = paletteImage(palette)
+            images2 = []
+            for im in images:
+                if isinstance(im, Image.Image):
+                    im = np.asarray(im.convert('RGB'))
+                if dither:
+                    im = Image.fromarray(rgbArray(im), 'RGB')
+                    im = im.quantize(palette=palImage)
+                else:
+                    im = Image.fromarray(paletteIndices(im, palette), 'P')
+                    im.putpalette(palList)
+                images2.append(im)
+            return images2
+        
         # Convert to PIL images
         images2 = []
         for im in images:
@@ -410,7 +586,7 @@ class GifWriter:
         # Obtain palette for all images and count each occurrence
         palettes, occur = [], []
         for im in images:
-            palettes.append( getheader(im)[1] )
+            palettes.append( getPalette(im) )
         for palette in palettes:
             occur.append( palettes.count( palette ) )
         
@@ -443,15 +619,16 @@ class GifWriter:
                 # Write palette and image data
         
                 # Gather info
-                data = getdata(im)
-                imdes, data = data[0], data[1:]
+                # the image descriptor (10 bytes) and LZW minimum size code,
+                # then the image data (PIL and Pillow split them differently)
+                data = [''.join(getdata(im))[11:]]
                 graphext = self.getGraphicsControlExt(durations[frames],
                                                         disposes[frames])
                 # Make image descriptor suitable for using 256 local color palette
                 lid = self.getImageDescriptor(im, xys[frames])
         
                 # Write local header
-                if (palette != globalPalette) or (disposes[frames] != 2):
+                if palette != globalPalette:
                     # Use local color palette
                     fp.write(graphext)
                     fp.write(lid) # write suitable image descriptor
@@ -460,7 +637,8 @@ class GifWriter:
                 else:
                     # Use global color palette
                     fp.write(graphext)
-                    fp.write(imdes) # write suitable image descriptor
+                    fp.write(self.getImageDescriptor(im, xys[frames], False))
+                    fp.write('\x08') # LZW minimum size code
         
                 # Write image data
                 for d in data:
@@ -478,9 +656,9 @@ class GifWriter:
 ## Exposed functions
 
 def writeGif(filename, images, duration=0.1, repeat=True, dither=False, 
-                nq=0, subRectangles=True, dispose=None):
+                nq=0, subRectangles=True, dispose=None, palette=None):
     """ writeGif(filename, images, duration=0.1, repeat=True, dither=False,
-                    nq=0, subRectangles=True, dispose=None)
+                    nq=0, subRectangles=True, dispose=None, palette=None)
     
     Write an animated gif from the specified images.
     
@@ -517,6 +695,12 @@ def writeGif(filename, images, duration=0.1, repeat=True, dither=False,
         in place. 2 means the background color should be restored after
         each frame. 3 means the decoder should restore the previous frame.
         If subRectangles==False, the default is 2, otherwise it is 1.
+    palette : None, 'global', or an array of at most 256 RGB colors
+        If given, all frames use this palette (stored only once in the file),
+        and are mapped onto it with a fast vectorized lookup. 'global' 
+        computes one palette for all images (see getGlobalPalette): exactly
+        their colors if there are at most 256, as is typical for rendered 
+        games. By default, each image is quantized separately.
     
     """
     
@@ -567,7 +751,9 @@ def writeGif(filename, images, duration=0.1, repeat=True, dither=False,
     
     
     # Make images in a format that we can write easy
-    images = gifWriter.convertImagesToPIL(images, dither, nq)
+    if isinstance(palette, basestring):
+        palette = getGlobalPalette(images, nq)
+    images = gifWriter.convertImagesToPIL(images, dither, nq, palette)
     
     # Write
     fp = open(filename, 'wb')
@@ -578,6 +764,154 @@ def writeGif(filename, images, duration=0.1, repeat=True, dither=False,
 
 
 
+class GifStreamWriter:
+    """ GifStreamWriter(filename, duration=0.1, repeat=True, 
+                        subRectangles=True, dispose=None, palette=None)
+    
+    Write an animated gif one frame at a time. Each frame given to addFrame
+    (a numpy array or PIL image) is cropped to the rectangle that changed
+    since the previous frame (if subRectangles), and written to the file
+    right away. Only the previous frame is kept, so the memory use does not
+    depend on the number of frames. Call close() after the last frame.
+    
+    All frames use one global palette: the given one (an array of at most 
+    256 RGB colors), or by default the colors of the frames as they occur.
+    Colors that do not fit into the 256 entries are mapped onto the closest
+    ones. The color table is written again when closing, once all colors
+    are known.
+    
+    """
+    
+    def __init__(self, filename, duration=0.1, repeat=True, 
+                    subRectangles=True, dispose=None, palette=None):
+        
+        # Check PIL and Numpy
+        if PIL is None:
+            raise RuntimeError("Need PIL to write animated gif files.")
+        if np is None:
+            raise RuntimeError("Need Numpy to write animated gif files incrementally.")
+        
+        self.duration = duration
+        self.subRectangles = subRectangles
+        
+        # Check loops
+        if repeat is False:
+            self.loops = 1
+        elif repeat is True:
+            self.loops = 0 # zero means infinite
+        else:
+            self.loops = int(repeat)
+        
+        # Check dispose
+        if dispose is None:
+            if subRectangles:
+                dispose = 1 # Leave image in place
+            else:
+                dispose = 2 # Restore to background color.
+        self.dispose = dispose
+        
+        # The palette, as color keys in the order of the color table
+        self._growPalette = palette is None
+        if palette is None:
+            self._keys = np.zeros(0, np.uint32)
+        else:
+            self._keys = colorKeys(np.asarray(palette, np.uint8).reshape(-1, 1, 3))
+        
+        self.frames = 0
+        self._gifWriter = GifWriter()
+        self._prev = None
+        self._paletteOffset = None
+        self._fp = open(filename, 'wb')
+    
+    
+    def _paletteBytes(self):
+        pal = paletteList(keysToColors(self._keys))
+        return np.array(pal, np.uint8).tostring()
+    
+    
+    def _paletteIndices(self, im):
+        """ Map the image onto the palette, after adding its new colors
+        to the palette (as long as there is room). """
+        if self._growPalette and len(self._keys) < 256:
+            keys = colorKeys(im)
+            if len(self._keys):
+                known = np.sort(self._keys)
+                pos = np.searchsorted(known, keys).clip(0, len(known) - 1)
+                keys = keys[known[pos] != keys]
+            if len(keys):
+                new = np.unique(keys)[:256 - len(self._keys)]
+                self._keys = np.concatenate([self._keys, new])
+        return paletteIndices(im, keysToColors(self._keys))
+    
+    
+    def addFrame(self, im, duration=None):
+        """ addFrame(im, duration=None)
+        
+        Write the next frame (which must have the size of the first one),
+        shown for the given duration (by default, the writer's).
+        
+        """
+        
+        # Check image
+        im = checkImages([im])[0]
+        if isinstance(im, PIL.Image):
+            im = np.asarray(im.convert('RGB'))
+        im = rgbArray(im)
+        
+        # Only the rectangle that changed since the previous frame
+        x0, y0 = 0, 0
+        crop = im
+        if self._prev is not None:
+            if self._prev.shape != im.shape:
+                raise ValueError("All frames must have the same size.")
+            if self.subRectangles:
+                x0, x1, y0, y1 = self._gifWriter.getDiffRectangle(self._prev, im)
+                crop = im[y0:y1,x0:x1]
+        pim = PIL.fromarray(self._paletteIndices(crop), 'P')
+        
+        fp = self._fp
+        if self._prev is None:
+            # Write header, with the current palette as the global one
+            fp.write(self._gifWriter.getheaderAnim(pim))
+            self._paletteOffset = fp.tell()
+            fp.write(self._paletteBytes())
+            fp.write(self._gifWriter.getAppExt(self.loops))
+            self._prev = im.copy()
+        else:
+            # Reuse the buffer: the caller may change im afterwards
+            self._prev[...] = im
+        
+        # Write the frame with the global palette
+        if duration is None:
+            duration = self.duration
+        fp.write(self._gifWriter.getGraphicsControlExt(duration, self.dispose))
+        fp.write(self._gifWriter.getImageDescriptor(pim, (x0, y0), False))
+        fp.write('\x08') # LZW minimum size code
+        fp.write(''.join(getdata(pim))[11:])
+        self.frames += 1
+    
+    
+    def close(self):
+        """ close()
+        
+        End the gif file, and write the final palette into its header.
+        
+        """
+        if self._fp is None:
+            return
+        try:
+            if self._prev is not None:
+                self._fp.write(";")  # end gif
+                if self._growPalette:
+                    self._fp.seek(self._paletteOffset)
+                    self._fp.write(self._paletteBytes())
+        finally:
+            self._fp.close()
+            self._fp = None
+            self._prev = None
+
+
+
 def readGif(filename, asNumpy=True):
     """ readGif(filename, asNumpy=True)
     
@@ -758,7 +1092,11 @@ class NeuQuant:
         
         # Initialize
         self.setconstants(samplefac, colors)
-        self.pixels = np.fromstring(image.tostring(), np.uint32)
+        if hasattr(image, 'tobytes'):
+            # Pillow
+            self.pixels = np.fromstring(image.tobytes(), np.uint32)
+        else:
+            self.pixels = np.fromstring(image.tostring(), np.uint32)
         self.setUpArrays()
         
         self.learn()
@@ -1014,37 +1352,30 @@ class NeuQuant:
     
     
     def quantize_with_scipy(self, image):
-        w,h = image.size
-        px = np.asarray(image).copy()
-        px2 = px[:,:,:3].reshape((w*h,3))
+        """ Every distinct color of the image is looked up once in the kdtree. """
+        px = np.asarray(image)
+        uniq, inverse = np.unique(colorKeys(px), return_inverse=True)
+        uniqColors = keysToColors(uniq)
         
         cKDTree = get_cKDTree()
         kdtree = cKDTree(self.colormap[:,:3],leafsize=10)
-        result = kdtree.query(px2)
-        colorindex = result[1]
-        print("Distance: %1.2f" % (result[0].sum()/(w*h)) )
-        px2[:] = self.colormap[colorindex,:3]
+        result = kdtree.query(uniqColors)
+        print("Distance: %1.2f" % (result[0][inverse].mean()) )
+        indices = result[1].astype(np.uint8)[inverse].reshape(px.shape[:2])
         
-        return Image.fromarray(px).convert("RGB").quantize(palette=self.paletteImage())
+        im = Image.fromarray(indices, 'P')
+        im.putpalette(paletteList(self.colormap[:,:3]))
+        return im
     
     
     def quantize_without_scipy(self, image):
         """" This function can be used if no scipy is availabe. 
-        It's 7 times slower though.
+        Every distinct color of the image is looked up once, vectorized.
         """
-        w,h = image.size
-        px = np.asarray(image).copy()
-        memo = {}
-        for j in range(w):
-            for i in range(h):
-                key = (px[i,j,0],px[i,j,1],px[i,j,2])
-                try:
-                    val = memo[key]
-                except KeyError:
-                    val = self.convert(*key)
-                    memo[key] = val
-                px[i,j,0],px[i,j,1],px[i,j,2] = val
-        return Image.fromarray(px).convert("RGB").quantize(palette=self.paletteImage())
+        palette = self.colormap[:,:3]
+        im = Image.fromarray(paletteIndices(np.asarray(image), palette), 'P')
+        im.putpalette(paletteList(palette))
+        return im
     
     def convert(self, *color):
         i = self.inxsearch(*color)
@@ -0,0 +1,327 @@
+'''
+Throughput benchmark across all example games.
+
+For every game/level pair of the examples (the maze games on each of the shared maze levels),
+measures (with fixed random seeds):
+ - headless steps per second under uniformly random actions
+ - parsing and level building time
+ - reset time (restoring the initial full state with setFullState)
+ - snapshot and restore time (as used for rollouts)
+ - peak memory
+
+Every case runs several times, each in a fresh forked process (so the memory numbers
+are not mixed up), in separate passes over all cases: the speed of a process, or of the machine
+for a while, can be off as a whole. Timings are the medians of all their samples, from all
+processes, stored along with their interquartile range. Calls under 10ms are repeated ten times
+as often, and the random play is replayed (the same actions, from the same state) a few times
+per process. Random play is cut short after a time limit (some games slow down a lot as they fill up),
+and cases that crash are reported with their error instead of metrics.
+
+    python tests/benchmark.py --output results.json
+    python tests/benchmark.py --compare results.json [--tolerance 0.2] [--spread 1]
+
+In comparison mode, every metric that is worse than the stored one by more than
+the tolerance (relative), and also by more than the spread of the two runs (by default
+the sum of their interquartile ranges), is flagged, and the exit code is nonzero.
+'''
+
+import os
+import sys
+import json
+import resource
+import importlib
+from time import time
+from random import seed, choice
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+# the levels of mazes.simple, shared by the games of mazes.mazegames
+maze_levels = ['maze_level_0', 'maze_level_1', 'maze_level_1b', 'maze_level_2', 'maze_level_3',
+               'office_layout', 'office_layout_2', 'corridor2', 'consistent_corridor']
+
+
+def crossCases(prefix, module, game_vars, level_module, level_exprs):
+    """ The cases of every combination of games and levels, named prefix-game-level. """
+    return [('%s-%s-%s' % (prefix, game_var[:-len('_game')], level_expr), module, game_var, level_module, level_expr)
+            for game_var in game_vars for level_expr in level_exprs]
+
+
+# every game/level pair of the examples: (name, module in examples, game variable,
+# module of the level, level expression evaluated in that module).
+# Not included: the shared base definitions mazegames.commonmaze_game and windy.windymaze_game,
+# which are not complete games, and frogs_video, which replays the frogs game.
+cases = ([('aliens', 'gridphysics.aliens', 'aliens_game', 'gridphysics.aliens', 'aliens_level'),
+          ('boulderdash', 'gridphysics.boulderdash', 'boulderdash_game', 'gridphysics.boulderdash', 'boulderdash_level'),
+          ('butterflies', 'gridphysics.butterflies', 'chase_game', 'gridphysics.butterflies', 'chase_level'),
+          ('chase', 'gridphysics.chase', 'chase_game', 'gridphysics.chase', 'chase_level'),
+          ('dodge', 'gridphysics.dodge', 'bullet_game', 'gridphysics.dodge', 'bullet_level'),
+          ('frogs', 'gridphysics.frogs', 'frog_game', 'gridphysics.frogs', 'frog_level'),
+          ('missilecommand', 'gridphysics.missilecommand', 'missilecommand_game',
+           'gridphysics.missilecommand', 'missilecommand_level'),
+          ('mrpacman', 'gridphysics.mrpacman', 'pacman_game', 'gridphysics.mrpacman', 'pacman_level'),
+          ('portals', 'gridphysics.portals', 'portal_game', 'gridphysics.portals', 'portal_level'),
+          ('sokoban', 'gridphysics.sokoban', 'push_game', 'gridphysics.sokoban', 'box_level'),
+          ('survivezombies', 'gridphysics.survivezombies', 'zombie_game', 'gridphysics.survivezombies', 'zombie_level'),
+          ('zelda', 'gridphysics.zelda', 'zelda_game', 'gridphysics.zelda', 'zelda_level')]
+         + crossCases('mazes', 'gridphysics.mazes.mazegames', ['maze_game', 'polarmaze_game', 'flippolarmaze_game'],
+                      'gridphysics.mazes.simple', maze_levels)
+         + [('fovea', 'gridphysics.mazes.fovea', 'maze_game', 'gridphysics.mazes.fovea', 'fovea_floor'),
+            ('noisymaze', 'gridphysics.mazes.noisyobservations', 'noisy_maze',
+             'gridphysics.mazes.noisyobservations', 'maze_89'),
+            ('prey', 'gridphysics.mazes.prey', 'chasemaze_game', 'gridphysics.mazes.prey', 'openmaze(8)'),
+            ('rigidzelda', 'gridphysics.mazes.rigidzelda', 'rigidzelda_game', 'gridphysics.mazes.rigidzelda', 'zelda_level'),
+            ('wrapmaze', 'gridphysics.mazes.ringworld', 'wrapmaze_game', 'gridphysics.mazes.ringworld', 'ringworld(19)'),
+            ('portalmaze', 'gridphysics.mazes.ringworld', 'portalmaze_game',
+             'gridphysics.mazes.ringworld', 'portalringworld(19)'),
+            ('stochmaze', 'gridphysics.mazes.stochastic', 'stoch_game', 'gridphysics.mazes.stochastic', 'stoch_level'),
+            ('tmaze', 'gridphysics.mazes.tmaze', 'Tmaze_game', 'gridphysics.mazes.tmaze', 'tmaze(4)'),
+            ('polartmaze', 'gridphysics.mazes.tmaze', 'polarTmaze_game', 'gridphysics.mazes.tmaze', 'tmaze(4)'),
+            ('windy_det', 'gridphysics.mazes.windy', 'windy_det_game', 'gridphysics.mazes.windy', 'windy_level'),
+            ('windy_stoch', 'gridphysics.mazes.windy', 'windy_stoch_game', 'gridphysics.mazes.windy', 'windy_level'),
+            ('artillery', 'continuousphysics.artillery', 'artillery_game', 'continuousphysics.artillery', 'artillery_level'),
+            ('lander', 'continuousphysics.lander', 'lander_game', 'continuousphysics.lander', 'lander_level'),
+            ('mario', 'continuousphysics.mario', 'mario_game', 'continuousphysics.mario', 'mario_level'),
+            ('pong', 'continuousphysics.pong', 'pong_game', 'continuousphysics.pong', 'pong_level'),
+            ('ptsp', 'continuousphysics.ptsp', 'ptsp_game', 'continuousphysics.ptsp', 'ptsp_level'),
+            ('ptsp_simple', 'continuousphysics.ptsp_simple', 'ptsp_game', 'continuousphysics.ptsp_simple', 'ptsp_level'),
+            ('tankwars', 'continuousphysics.tankwars', 'tankwars_game', 'continuousphysics.tankwars', 'tankwars_level'),
+            ])
+
+# for each metric, whether larger values are better, and the absolute
+# difference below which a change is considered noise (whatever the measured spread)
+metrics = {'steps_per_sec': (True, 0),
+           'parse_ms': (False, 0.05),
+           'build_ms': (False, 0.05),
+           'reset_ms': (False, 0.05),
+           'snapshot_ms': (False, 0.05),
+           'restore_ms': (False, 0.05),
+           'peak_memory_kb': (False, 256),
+           }
+
+
+def loadCase(module, game_var, level_module, level_expr):
+    game_str = getattr(importlib.import_module('examples.' + module), game_var)
+    m = importlib.import_module('examples.' + level_module)
+    return game_str, eval(level_expr, vars(m))
+
+
+def _quartiles(xs):
+    xs = sorted(xs)
+    return xs[len(xs) // 4], xs[len(xs) // 2], xs[(3 * len(xs)) // 4]
+
+
+def _sampled(measure, repeats, fastRepeats=10):
+    """ The durations returned by repeated calls of measure, in milliseconds.
+    If they are under 10ms, it is repeated fastRepeats times as often. """
+    res = [measure() for _ in range(repeats)]
+    if _quartiles(res)[1] < 0.01:
+        res += [measure() for _ in range(repeats * (fastRepeats - 1))]
+    return [x * 1000 for x in res]
+
+
+def _timed(fun, repeats):
+    """ The times of repeated function calls, in milliseconds. """
+    def measure():
+        start = time()
+        fun()
+        return time() - start
+    return _sampled(measure, repeats)
+
+
+def benchmarkCase(game_str, map_str, steps=2000, repeats=10, randomseed=1, maxSeconds=10, plays=5):
+    """ All metrics of one game/level pair (for the timings, the lists of samples). """
+    import pygame
+    from numpy import random as nprandom
+    from vgdl.core import VGDLParser
+    from vgdl.rollouts import snapshot, restore
+    seed(randomseed)
+    nprandom.seed(randomseed)
+    startmem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    res = {}
+
+    res['parse_ms'] = _timed(lambda: VGDLParser().parseGame(game_str), repeats)
+
+    def build():
+        g = VGDLParser().parseGame(game_str)
+        start = time()
+        g.buildLevel(map_str)
+        return time() - start
+    res['build_ms'] = _sampled(build, repeats)
+
+    g = VGDLParser().parseGame(game_str)
+    g.buildLevel(map_str)
+    g.randomizeAvatar()
+    g._initScreen(g.screensize, headless=True)
+    fs = g.getFullState()
+    res['reset_ms'] = _timed(lambda: g.setFullState(fs), repeats)
+
+    g = VGDLParser().parseGame(game_str)
+    g.buildLevel(map_str)
+    g.randomizeAvatar()
+    g._initScreen(g.screensize, headless=True)
+    init = snapshot(g)
+    res['snapshot_ms'] = _timed(lambda: snapshot(g), repeats)
+    res['restore_ms'] = _timed(lambda: restore(g, init), repeats)
+
+    # random play, restarting from the initial state whenever the game ends
+    actions = [None] + sorted(g.getPossibleActions().values())
+
+    def play(steps, maxSeconds):
+        seed(randomseed)
+        nprandom.seed(randomseed)
+        restore(g, init)
+        elapsed = 0.
+        episodes = 1
+        done = 0
+        while done < steps and elapsed < maxSeconds:
+            a = choice(actions)
+            start = time()
+            g.tick(a)
+            g._clearAll(False)
+            elapsed += time() - start
+            done += 1
+            if g.ended:
+                restore(g, init)
+                episodes += 1
+        return done, elapsed, episodes
+    # the time limit is shared among the plays, the later ones replay the first
+    done, elapsed, episodes = play(steps, maxSeconds / float(plays))
+    res['steps_per_sec'] = [done / elapsed] + [done / play(done, float('inf'))[1] for _ in range(plays - 1)]
+    res['steps'] = done
+    res['episodes'] = episodes
+    res['sprites'] = len(list(g))
+    res['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - startmem
+    pygame.quit()
+    return res
+
+
+def _runForked(args):
+    # the games' own messages would drown the results
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return benchmarkCase(*args)
+    except Exception, e:
+        return {'error': '%s: %s' % (e.__class__.__name__, e)}
+
+
+def _runFresh(args):
+    """ Benchmark a case in a fresh process. """
+    from multiprocessing import Pool
+    pool = Pool(1)
+    try:
+        return pool.apply(_runForked, [args])
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _summarize(runs):
+    """ The metrics of a case over several runs: for the timings, the median and interquartile range
+    of the samples of all runs, otherwise the median. """
+    errors = [r for r in runs if 'error' in r]
+    if errors:
+        return errors[0]
+    res = {}
+    for m in runs[0]:
+        values = [r[m] for r in runs]
+        if isinstance(values[0], list):
+            q1, res[m], q3 = _quartiles(sum(values, []))
+            res[m + '_iqr'] = q3 - q1
+        else:
+            res[m] = _quartiles(values)[1]
+    return res
+
+
+def runAll(names=None, steps=2000, repeats=10, randomseed=1, maxSeconds=10, processes=3, verbose=True):
+    selected = [c for c in cases if not names or c[0] in names]
+    runs = dict((c[0], []) for c in selected)
+    # one pass over all cases per run, so the runs of a case are spread out in time
+    for _ in range(processes):
+        for name, module, game_var, level_module, level_expr in selected:
+            game_str, map_str = loadCase(module, game_var, level_module, level_expr)
+            runs[name].append(_runFresh((game_str, map_str, steps, repeats, randomseed, maxSeconds)))
+    results = {}
+    for name, _, _, _, _ in selected:
+        results[name] = r = _summarize(runs[name])
+        if verbose and 'error' in r:
+            print '%-40s failed: %s' % (name, r['error'])
+        elif verbose:
+            print '%-40s %9.0f steps/s  parse %6.2fms  build %6.2fms  reset %6.2fms  snapshot %6.3fms  restore %6.3fms  mem %6dkB' % (
+                name, r['steps_per_sec'], r['parse_ms'], r['build_ms'], r['reset_ms'],
+                r['snapshot_ms'], r['restore_ms'], r['peak_memory_kb'])
+    return {'python': sys.version.split()[0],
+            'steps': steps,
+            'max_seconds': maxSeconds,
+            'repeats': repeats,
+            'processes': processes,
+            'seed': randomseed,
+            'results': results}
+
+
+def compare(current, baseline, tolerance=0.2, spread=1.):
+    """ Returns the list of (case, metric, baseline value, current value)
+    that got worse by more than the tolerance (relative), and by more than the spread times
+    the sum of the interquartile ranges of both runs (where they were measured). """
+    regressions = []
+    for name, r in sorted(current['results'].iteritems()):
+        if name not in baseline['results']:
+            continue
+        b = baseline['results'][name]
+        if 'error' in r and 'error' not in b:
+            regressions.append((name, 'error', None, None))
+            continue
+        for m, (larger, noise) in sorted(metrics.iteritems()):
+            if m not in b or m not in r:
+                continue
+            noise = max(noise, spread * (b.get(m + '_iqr', 0) + r.get(m + '_iqr', 0)))
+            if abs(r[m] - b[m]) <= noise:
+                continue
+            if larger:
+                worse = r[m] < b[m] * (1 - tolerance)
+            else:
+                worse = r[m] > b[m] * (1 + tolerance)
+            if worse:
+                regressions.append((name, m, b[m], r[m]))
+    return regressions
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='VGDL throughput benchmark.')
+    parser.add_argument('games', nargs='*', help='subset of the cases to run (default: all)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of baseline results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slack before flagging a regression')
+    parser.add_argument('--spread', type=float, default=1.,
+                        help='slack before flagging a regression, in interquartile ranges (of both runs)')
+    parser.add_argument('--steps', type=int, default=2000)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--processes', type=int, default=3, help='fresh processes (runs) per case')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--max-seconds', type=float, default=10, help='time limit of the random play per case')
+    args = parser.parse_args(argv)
+
+    current = runAll(args.games, args.steps, args.repeats, args.seed, args.max_seconds, args.processes)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=1, sort_keys=True)
+    else:
+        print json.dumps(current, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.tolerance, args.spread)
+        for name, m, b, r in regressions:
+            if m == 'error':
+                print 'REGRESSION %-40s %s' % (name, current['results'][name]['error'])
+            else:
+                print 'REGRESSION %-40s %-15s %10.3f -> %10.3f' % (name, m, b, r)
+        if regressions:
+            return 1
+        print 'No regressions.'
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
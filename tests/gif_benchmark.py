@@ -0,0 +1,118 @@
+'''
+Benchmark of the GIF export of a rollout: the former pipeline (saving every frame as a PNG file,
+re-opening it with PIL, and writing all the frames at the end) against the GifRecorder,
+which writes the changed area of each frame right away (its memory use should not grow with --steps).
+
+The rollout plays random actions on the aliens game (restarting the level whenever it ends),
+drawn on a dummy display. Each pipeline runs in its own forked process, for the memory numbers.
+
+    python tests/gif_benchmark.py --steps 500
+'''
+
+import os
+import sys
+import shutil
+import resource
+import tempfile
+from time import time
+from random import seed, choice
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def rollout(steps, randomseed=1):
+    """ Plays the game on the screen, yields it after every step. """
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    from numpy import random as nprandom
+    from vgdl.core import VGDLParser
+    from examples.gridphysics.aliens import aliens_game, aliens_level
+    seed(randomseed)
+    nprandom.seed(randomseed)
+    g = None
+    for _ in range(steps):
+        if g is None or g.ended:
+            g = VGDLParser().parseGame(aliens_game)
+            g.buildLevel(aliens_level)
+            g._initScreen(g.screensize, headless=False)
+            actions = [None] + sorted(g.getPossibleActions().values())
+        g.tick(choice(actions), headless=False)
+        yield g
+
+
+def pngPipeline(steps, filename, tmpdir):
+    import pygame
+    from external_libs.images2gif import writeGif
+    try:
+        import Image
+    except ImportError:
+        from PIL import Image
+    images = []
+    start = time()
+    for i, g in enumerate(rollout(steps)):
+        fn = os.path.join(tmpdir, 'tmp%05d.png' % i)
+        pygame.image.save(g.screen, fn)
+        images.append(Image.open(fn))
+    captured = time()
+    writeGif(filename, images, duration=0.1, dither=0)
+    return captured - start, time() - captured
+
+
+def streamPipeline(steps, filename, tmpdir):
+    from vgdl.recording import GifRecorder
+    recorder = None
+    start = time()
+    for g in rollout(steps):
+        if recorder is None:
+            recorder = GifRecorder(filename, g.screensize, duration=0.1)
+        recorder.addFrame(g)
+    captured = time()
+    recorder.close()
+    return captured - start, time() - captured
+
+
+pipelines = {'png': pngPipeline,
+             'stream': streamPipeline}
+
+
+def _runForked(args):
+    name, steps = args
+    sys.stdout = open(os.devnull, 'w')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'rollout.gif')
+        startmem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        capture, write = pipelines[name](steps, filename, tmpdir)
+        return {'capture_s': capture, 'write_s': write, 'total_s': capture + write,
+                'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - startmem,
+                'gif_kb': os.path.getsize(filename) / 1024.}
+    except Exception, e:
+        return {'error': '%s: %s' % (e.__class__.__name__, e)}
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main(argv=None):
+    import argparse
+    from multiprocessing import Pool
+    parser = argparse.ArgumentParser(description='Benchmark of the GIF export of a rollout.')
+    parser.add_argument('pipelines', nargs='*', help='subset of %s (default: all)' % sorted(pipelines))
+    parser.add_argument('--steps', type=int, default=500)
+    args = parser.parse_args(argv)
+    for name in args.pipelines or ['png', 'stream']:
+        # a fresh process per pipeline
+        pool = Pool(1)
+        try:
+            r = pool.apply(_runForked, [(name, args.steps)])
+        finally:
+            pool.close()
+            pool.join()
+        if 'error' in r:
+            print '%-8s failed: %s' % (name, r['error'])
+        else:
+            print '%-8s capture %7.2fs  write %7.2fs  total %7.2fs  mem %8dkB  gif %8.0fkB' % (
+                name, r['capture_s'], r['write_s'], r['total_s'], r['peak_memory_kb'], r['gif_kb'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
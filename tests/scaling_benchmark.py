@@ -0,0 +1,267 @@
+'''
+Scaling benchmark on synthetic levels, to make algorithmic hot spots visible.
+
+The shipped levels are tiny, so this generates random levels for some of the example games
+(maze, aliens, boulderdash, zelda) at configurable sizes (e.g. 20x20 up to 500x500)
+and sprite densities (the fraction of the interior cells that are occupied).
+
+Per level it measures the level building time, headless steps per second under random actions,
+the time per tick spent on collision handling, emptyBlocks and (for the static maze)
+the observations of the GameEnvironment, and the peak memory (from building the level on).
+
+For each game and density, the exponents of a power law fit (time per step, and memory,
+against the number of sprites) summarize the asymptotic behaviour; in comparison mode,
+exponents that grew by more than the tolerance are flagged as regressions.
+
+    python tests/scaling_benchmark.py --sizes 20 50 100 200 500 --output scaling.json --chart scaling.png
+    python tests/scaling_benchmark.py --compare scaling.json
+'''
+
+import os
+import sys
+import json
+import resource
+import importlib
+from time import time
+from random import Random, seed, choice
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+# per game: the module in examples, the game variable, the characters filling the occupied
+# cells (with relative weights), and the characters placed exactly once
+games = {'maze': ('gridphysics.mazes', 'maze_game', [('w', 1.)], ['A', 'G']),
+         'aliens': ('gridphysics.aliens', 'aliens_game', [('0', 1.)], ['A', '1']),
+         'boulderdash': ('gridphysics.boulderdash', 'boulderdash_game',
+                         [('.', 6.), ('o', 2.), ('x', 1.), ('w', 1.), ('c', .1), ('b', .1)], ['A', 'E']),
+         'zelda': ('gridphysics.zelda', 'zelda_game', [('w', 4.), ('1', .5)], ['A', '+', 'G']),
+         }
+
+# emptyBlocks tests every cell against every sprite: skip it above this many pairs
+MAX_EMPTYBLOCKS_PAIRS = 2e7
+
+
+def syntheticLevel(game, width, height, density, randomseed=1):
+    """ A level string with walls around, where the given fraction of interior cells
+    is occupied (following the game's character weights). """
+    _, _, fill, singles = games[game]
+    rng = Random(randomseed)
+    total = sum(w for _, w in fill)
+    rows = [['w'] * width] + [['w'] + [' '] * (width - 2) + ['w'] for _ in range(height - 2)] + [['w'] * width]
+    free = []
+    for y in range(1, height - 1):
+        for x in range(1, width - 1):
+            if rng.random() < density:
+                r = rng.random() * total
+                for c, w in fill:
+                    r -= w
+                    if r < 0:
+                        break
+                rows[y][x] = c
+            else:
+                free.append((x, y))
+    for c, (x, y) in zip(singles, rng.sample(free, len(singles))):
+        rows[y][x] = c
+    return '\n'.join(''.join(r) for r in rows)
+
+
+def scalingCase(game, size, density, steps=100, minSteps=3, maxSeconds=20, randomseed=1):
+    """ All metrics of one synthetic level. """
+    import pygame
+    from numpy import random as nprandom
+    from vgdl.core import VGDLParser
+    from vgdl.interfaces import GameEnvironment
+    seed(randomseed)
+    nprandom.seed(randomseed)
+    module, game_var, _, _ = games[game]
+    game_str = getattr(importlib.import_module('examples.' + module), game_var)
+    map_str = syntheticLevel(game, size, size, density, randomseed)
+    res = {'game': game, 'size': size, 'density': density, 'cells': size * size}
+
+    g = VGDLParser().parseGame(game_str)
+    # the default limit would cut the large levels short
+    g.MAX_SPRITES = size * size * 2
+    startmem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time()
+    g.buildLevel(map_str)
+    res['build_ms'] = (time() - start) * 1000
+    res['sprites'] = len(list(g))
+    g._initScreen(g.screensize, headless=True)
+
+    if res['cells'] * res['sprites'] <= MAX_EMPTYBLOCKS_PAIRS:
+        start = time()
+        g.emptyBlocks()
+        res['emptyblocks_ms'] = (time() - start) * 1000
+
+    if game == 'maze':
+        env = GameEnvironment(g)
+        start = time()
+        for _ in range(10):
+            env.getSensors()
+        res['sensors_ms'] = (time() - start) * 100
+
+    # random play (the game is not restarted when it ends)
+    actions = [None] + sorted(g.getPossibleActions().values())
+    elapsed = 0.
+    done = 0
+    while not g.ended and done < steps and (elapsed < maxSeconds or done < minSteps):
+        a = choice(actions)
+        start = time()
+        g.tick(a)
+        g._clearAll(False)
+        elapsed += time() - start
+        done += 1
+    res['steps'] = done
+    res['step_ms'] = elapsed / max(done, 1) * 1000
+    res['steps_per_sec'] = done / elapsed if elapsed > 0 else None
+
+    # a few more ticks, to time the collision handling
+    prof = g.enableProfiling()
+    for _ in range(minSteps):
+        if g.ended:
+            break
+        g.tick(choice(actions))
+        g._clearAll(False)
+    if prof.ticks > 0:
+        res['eventhandling_ms'] = sum(prof.samples['eventHandling']) / prof.ticks * 1000
+    res['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - startmem
+    pygame.quit()
+    return res
+
+
+def _runForked(args):
+    # the games' own messages would drown the results
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return scalingCase(*args)
+    except Exception, e:
+        return {'error': '%s: %s' % (e.__class__.__name__, e)}
+
+
+def exponents(results):
+    """ Per game and density: the slope of the log-log fit of the time per step
+    and of the memory against the number of sprites. """
+    from numpy import log, polyfit
+    groups = {}
+    for r in results:
+        if 'error' not in r and r['steps'] > 0:
+            groups.setdefault('%s@%s' % (r['game'], r['density']), []).append(r)
+    res = {}
+    for key, rs in sorted(groups.iteritems()):
+        if len(set(r['sprites'] for r in rs)) < 2:
+            continue
+        xs = log([r['sprites'] for r in rs])
+        res[key] = {'step_time': polyfit(xs, log([r['step_ms'] for r in rs]), 1)[0],
+                    'memory': polyfit(xs, log([max(r['peak_memory_kb'], 1) for r in rs]), 1)[0]}
+    return res
+
+
+def runAll(gamenames, sizes, densities, steps=100, maxSeconds=20, randomseed=1, verbose=True):
+    from multiprocessing import Pool
+    results = []
+    for game in gamenames:
+        for density in densities:
+            for size in sizes:
+                # a fresh process per case
+                pool = Pool(1)
+                try:
+                    r = pool.apply(_runForked, [(game, size, density, steps, 3, maxSeconds, randomseed)])
+                finally:
+                    pool.close()
+                    pool.join()
+                if 'error' in r:
+                    r.update({'game': game, 'size': size, 'density': density})
+                    if verbose:
+                        print '%-12s %4d %4.2f failed: %s' % (game, size, density, r['error'])
+                elif verbose:
+                    if 'eventhandling_ms' in r:
+                        collisions = '%9.2f' % r['eventhandling_ms']
+                    else:
+                        collisions = '%9s' % '-'
+                    print '%-12s %4d %4.2f %7d sprites %9.2f ms/step (collisions %s) build %8.1fms mem %7dkB' % (
+                        game, size, density, r['sprites'], r['step_ms'], collisions, r['build_ms'],
+                        r['peak_memory_kb'])
+                results.append(r)
+    return {'python': sys.version.split()[0],
+            'steps': steps,
+            'max_seconds': maxSeconds,
+            'seed': randomseed,
+            'results': results,
+            'exponents': exponents(results)}
+
+
+def chart(current, filename):
+    """ Steps per second and memory, against level size and sprite count (requires pylab). """
+    try:
+        import pylab
+    except ImportError:
+        print 'pylab is not available, no chart.'
+        return
+    pylab.figure(figsize=(12, 9))
+    panels = [('cells', 'steps_per_sec'), ('sprites', 'steps_per_sec'),
+              ('cells', 'peak_memory_kb'), ('sprites', 'eventhandling_ms')]
+    for i, (x, y) in enumerate(panels):
+        pylab.subplot(2, 2, i + 1)
+        keys = sorted(set((r['game'], r['density']) for r in current['results'] if 'error' not in r))
+        for game, density in keys:
+            rs = [r for r in current['results'] if 'error' not in r and r['game'] == game
+                  and r['density'] == density and r.get(y)]
+            pylab.loglog([r[x] for r in rs], [r[y] for r in rs], 'o-', label='%s %.2f' % (game, density))
+        pylab.xlabel(x)
+        pylab.ylabel(y)
+    pylab.legend(loc='best', fontsize='small')
+    pylab.tight_layout()
+    pylab.savefig(filename)
+
+
+def compare(current, baseline, tolerance=0.25):
+    """ Returns the list of (game@density, quantity, baseline exponent, current exponent)
+    where the exponent grew by more than the tolerance. """
+    regressions = []
+    for key, e in sorted(current['exponents'].iteritems()):
+        if key not in baseline['exponents']:
+            continue
+        for q, v in sorted(e.iteritems()):
+            b = baseline['exponents'][key].get(q)
+            if b is not None and v > b + tolerance:
+                regressions.append((key, q, b, v))
+    return regressions
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='VGDL scaling benchmark on synthetic levels.')
+    parser.add_argument('--games', nargs='*', default=sorted(games), choices=sorted(games))
+    parser.add_argument('--sizes', nargs='*', type=int, default=[20, 50, 100, 200])
+    parser.add_argument('--densities', nargs='*', type=float, default=[0.1, 0.3])
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--max-seconds', type=float, default=20, help='time limit of the random play per level')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--chart', help='plot the results to this image file')
+    parser.add_argument('--compare', help='JSON file of baseline results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='slack on the exponents before flagging a regression')
+    args = parser.parse_args(argv)
+
+    current = runAll(args.games, args.sizes, args.densities, args.steps, args.max_seconds, args.seed)
+    for key, e in sorted(current['exponents'].iteritems()):
+        print '%-20s time per step ~ sprites^%.2f, memory ~ sprites^%.2f' % (key, e['step_time'], e['memory'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=1, sort_keys=True)
+    if args.chart:
+        chart(current, args.chart)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.tolerance)
+        for key, q, b, v in regressions:
+            print 'REGRESSION %-20s %-10s exponent %.2f -> %.2f' % (key, q, b, v)
+        if regressions:
+            return 1
+        print 'No regressions.'
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
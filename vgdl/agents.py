@@ -8,8 +8,10 @@ These are based on the PyBrain RL framework of Agent classes.
 '''
 
 import pygame
+from math import sqrt, log, ceil
+from random import shuffle
+from time import time
 from pybrain.rl.agents.agent import Agent
-from pybrain.rl.learners.modelbased import policyIteration
 from pybrain.utilities import drawIndex
 
 from ontology import BASEDIRS
@@ -54,18 +56,188 @@ class PolicyDrivenAgent(Agent):
         return drawIndex(self.policy[self.stateIndexFun()])
 
     @staticmethod
-    def buildOptimal(game_env, discountFactor=0.99):
+    def buildOptimal(game_env, discountFactor=0.99, cache=None):
         """ Given a game, find the optimal (state-based) policy and
-        return an agent that is playing accordingly. """
+        return an agent that is playing accordingly.
+        The MDP conversion can be reused from an MDPcache. """
 
         from mdpmap import MDPconverter
-        C = MDPconverter(env=game_env)
+        from solvers import modifiedPolicyIteration
+        C = MDPconverter(env=game_env, cache=cache)
         Ts, R, _ = C.convert()
-        policy, _ = policyIteration(Ts, R, discountFactor=discountFactor)
+        _, policy, _ = modifiedPolicyIteration(Ts, R, discountFactor=discountFactor)
         game_env.reset()
 
         def x(*_):
-            s = game_env.getState()
-            i = C.states.index(s)
-            return i
+            return C.stateIndex[game_env.getState()]
         return PolicyDrivenAgent(policy, x)
+
+
+def stateHash(game):
+    """ A hash of the parts of the game state that usually matter for the future:
+    positions, orientations, speeds and resources of all sprites, and the score. """
+    return hash((game.score,
+                 tuple(sorted((sp.name, sp.rect.left, sp.rect.top, getattr(sp, 'orientation', None),
+                               sp.speed, tuple(sorted(sp.resources.items())))
+                              for sp in game))))
+
+
+class _SearchNode(object):
+    """ Visit counts and summed returns per action, and the children reached by them. """
+
+    def __init__(self, numactions):
+        self.visits = 0
+        self.counts = [0] * numactions
+        self.totals = [0.] * numactions
+        self.children = {}
+        # the order in which progressive widening admits the actions
+        self.order = range(numactions)
+        shuffle(self.order)
+
+
+class MCTSAgent(Agent):
+    """ Monte-Carlo tree search (UCT) that plans directly on a game (not an MDP),
+    using the game itself as the forward model. The tree is over action sequences
+    from the current state (open-loop), and its leaves are evaluated by random playouts.
+
+    Every decision gets a budget, either in seconds or in iterations.
+    For avatars with many actions (that can shoot), the tree is progressively widened:
+    a node visited n times only considers the first ceil(factor * n^exponent) of its actions.
+    Optionally, nodes are identified by the hash of the game state reached (transpositions)
+    rather than by their action sequence.
+
+    The actions returned are keys, to be passed on to BasicGame.tick.
+    """
+
+    # seconds per decision, if given, otherwise the number of iterations
+    timeBudget = None
+    iterations = 200
+    maxDepth = 10
+    rolloutDepth = 10
+    explorationConstant = sqrt(2)
+    discountFactor = 0.99
+    winReward = 100.
+    loseReward = -100.
+    # a (factor, exponent) pair, or None: only for SpriteProducer avatars, with (1, 0.5)
+    widening = None
+    transpositions = False
+    verbose = False
+
+    def __init__(self, game, actions=None, **kwargs):
+        from rollouts import RolloutEngine
+        from ontology import SpriteProducer
+        self.setArgs(**kwargs)
+        self.game = game
+        if actions is None:
+            actions = [None] + sorted(game.getPossibleActions().values())
+        self.actions = actions
+        if self.widening is None and isinstance(game.getAvatars()[0], SpriteProducer):
+            self.widening = (1., 0.5)
+        self._engine = RolloutEngine(game, actions, discountFactor=self.discountFactor,
+                                     winReward=self.winReward, loseReward=self.loseReward)
+        # statistics of the last decision
+        self.lastStats = None
+
+    def getAction(self):
+        return self.actions[self.plan()]
+
+    def plan(self):
+        """ Search from the current state of the game, return the index of the best action.
+        The game is left unchanged. """
+        E = self._engine
+        E.setRoot()
+        root = _SearchNode(len(self.actions))
+        table = {}
+        # the range of returns seen, to normalize the exploitation term
+        self._bounds = [None, None]
+        start = time()
+        its, ticks = 0, 0
+        while its == 0 or (time() - start < self.timeBudget if self.timeBudget is not None
+                           else its < self.iterations):
+            ticks += self._iterate(root, table)
+            its += 1
+        E.reset()
+        elapsed = time() - start
+        self.lastStats = {'iterations': its,
+                          'ticks': ticks,
+                          'time': elapsed,
+                          'iterationsPerSecond': its / max(elapsed, 1e-9)}
+        if self.verbose:
+            print 'MCTS: %(iterations)d iterations (%(iterationsPerSecond).1f/s), %(ticks)d ticks' % self.lastStats
+        # ties are broken by the (random) order of the actions
+        return max(root.order, key=lambda a: (root.counts[a], root.totals[a]))
+
+    def _iterate(self, root, table):
+        """ One selection, expansion, playout and backup. Returns the number of ticks simulated. """
+        E = self._engine
+        E.reset()
+        node, path, terminal, new = root, [], None, False
+        while not new and terminal is None and len(path) < self.maxDepth:
+            a, new = self._select(node)
+            r, terminal = E.step(a)
+            path.append((node, a, r))
+            if not new and terminal is None:
+                node = self._child(node, a, table)
+        G, steps = 0., 0
+        if terminal is None:
+            G, steps, _ = E.playout(self.rolloutDepth)
+        for node, a, r in reversed(path):
+            G = r + self.discountFactor * G
+            node.visits += 1
+            node.counts[a] += 1
+            node.totals[a] += G
+            lo, hi = self._bounds
+            if lo is None or G < lo:
+                self._bounds[0] = G
+            if hi is None or G > hi:
+                self._bounds[1] = G
+        return len(path) + steps
+
+    def _child(self, node, a, table):
+        if self.transpositions:
+            key = stateHash(self.game)
+            if key not in table:
+                table[key] = _SearchNode(len(self.actions))
+            return table[key]
+        if a not in node.children:
+            node.children[a] = _SearchNode(len(self.actions))
+        return node.children[a]
+
+    def _select(self, node):
+        """ The action to take from this node, and whether it is tried there for the first time. """
+        allowed = node.order
+        if self.widening is not None:
+            factor, exponent = self.widening
+            allowed = allowed[:max(1, int(ceil(factor * (node.visits + 1) ** exponent)))]
+        for a in allowed:
+            if node.counts[a] == 0:
+                return a, True
+        lo, hi = self._bounds
+        span = hi - lo if hi > lo else 1.
+        logn = log(node.visits)
+        return max(allowed, key=lambda a: ((node.totals[a] / node.counts[a] - lo) / span
+                                           + self.explorationConstant * sqrt(logn / node.counts[a]))), False
+
+
+def testMCTS(game_str=None, map_str=None, steps=50, **kwargs):
+    """ Play part of an episode, planning every step. """
+    from core import VGDLParser
+    if game_str is None:
+        from examples.gridphysics.aliens import aliens_game, aliens_level
+        game_str, map_str = aliens_game, aliens_level
+    g = VGDLParser().parseGame(game_str)
+    g.buildLevel(map_str)
+    agent = MCTSAgent(g, **kwargs)
+    for i in range(steps):
+        g.tick(agent.getAction())
+        g._clearAll(False)
+        print i, 'score', g.score, '%.1f iterations/s' % agent.lastStats['iterationsPerSecond']
+        for t in g.terminations[1:]:
+            ended, win = t.isDone(g)
+            if ended:
+                print 'Won' if win else 'Lost'
+                return
+
+
+if __name__ == '__main__':
+    testMCTS(iterations=100, verbose=True)
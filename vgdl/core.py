@@ -7,12 +7,11 @@ Video game description language -- parser, framework and core game classes.
 import pygame
 from random import choice
 from tools import Node, indentTreeParser
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from vgdl.tools import roundedPoints
+from instrumentation import NullProfiler
 import os
 import uuid
-import subprocess
-import glob
 
 
 class VGDLParser(object):
@@ -20,7 +19,7 @@ class VGDLParser(object):
     verbose = False
 
     @staticmethod
-    def playGame(game_str, map_str, headless=False, persist_movie=False, movie_dir="./tmpl"):
+    def playGame(game_str, map_str, headless=False, persist_movie=False, movie_dir="./videos/"):
         """ Parses the game and level map strings, and starts the game. """
         g = VGDLParser().parseGame(game_str)
         g.buildLevel(map_str)
@@ -29,7 +28,7 @@ class VGDLParser(object):
             g.startGameExternalPlayer(headless, persist_movie, movie_dir)
             #g.startGame(headless,persist_movie)
         else:
-            g.startGame(headless, persist_movie)
+            g.startGame(headless, persist_movie, movie_dir)
 
         return g
 
@@ -52,10 +51,13 @@ class VGDLParser(object):
 
     def parseGame(self, tree):
         """ Accepts either a string, or a tree. """
+        game_str = None
         if not isinstance(tree, Node):
+            game_str = tree
             tree = indentTreeParser(tree).children[0]
         sclass, args = self._parseArgs(tree.content)
         self.game = sclass(**args)
+        self.game.game_str = game_str
         for c in tree.children:
             if c.content == "SpriteSet":
                 self.parseSprites(c.children)
@@ -154,6 +156,17 @@ class BasicGame(object):
     frame_rate = 20
     load_save_enabled = True
 
+    # the descriptions the game was built from (if available), to identify it
+    game_str = None
+    level_str = None
+
+    # optional per-rule counters of the collision handling (see enableCollisionStats)
+    collision_stats = None
+    # optional timing of the phases of each tick (see enableProfiling), by default one that does nothing
+    profiler = NullProfiler()
+    # the video being recorded, if any (see startRecording)
+    recorder = None
+
     def __init__(self, **kwargs):
         from ontology import Immovable, DARKGRAY, MovingAvatar, GOLD
         for name, value in kwargs.iteritems():
@@ -184,8 +197,28 @@ class BasicGame(object):
         self.resources_limits = defaultdict(lambda: 2)
         self.resources_colors = defaultdict(lambda: GOLD)
 
+        # functions notified whenever a sprite gets killed
+        self.kill_callbacks = []
+        # incremented whenever the sprites are replaced by new objects wholesale (e.g. by setFullState),
+        # bypassing the kill callbacks
+        self._sprite_generation = 0
+        # the currently alive avatar(s), kept up-to-date on creation and killing
+        self._avatars = []
+
         self.is_stochastic = False
         self._lastsaved = None
+        # the sprite types pre-rendered into the background (determined when first drawn),
+        # and whether that background needs to be re-rendered
+        self._static_keys = None
+        self._static_dirty = True
+        self._background_onscreen = False
+        self._background_color = (0, 0, 0)
+        # offscreen frames (see render_array), and the static sprites in their pixel format
+        self._frame = None
+        self._frame_surface = None
+        self._frame_background = None
+        # per sprite type, the color in the tile rendering (see render_tiles)
+        self.tile_colors = {}
         self.reset()
 
     def reset(self):
@@ -197,6 +230,7 @@ class BasicGame(object):
 
     def buildLevel(self, lstr):
         from ontology import stochastic_effects
+        self.level_str = lstr
         lines = [l for l in lstr.split("\n") if len(l) > 0]
         lengths = map(len, lines)
         assert min(lengths) == max(lengths), "Inconsistent line lengths."
@@ -234,6 +268,8 @@ class BasicGame(object):
         # guarantee that avatar is always visible
         self.sprite_order.remove('avatar')
         self.sprite_order.append('avatar')
+        self._static_keys = None
+        self._staticsChanged()
 
     def emptyBlocks(self):
         alls = [s for s in self]
@@ -274,11 +310,23 @@ class BasicGame(object):
             s.stypes = stypes
             self.sprite_groups[key].append(s)
             self.num_sprites += 1
+            if isinstance(s, Avatar):
+                self._avatars.append(s)
+            if self._static_keys is not None and key in self._static_keys:
+                self._staticsChanged()
             if s.is_stochastic:
                 self.is_stochastic = True
             res.append(s)
         return res
 
+    def _killSprite(self, s):
+        """ Mark a sprite for removal (at the end of the timestep). """
+        self.kill_list.append(s)
+        if s in self._avatars:
+            self._avatars.remove(s)
+        for f in self.kill_callbacks:
+            f(s)
+
     def _createSprite_cheap(self, key, pos):
         """ The same, but without the checks, which speeds things up during load/saving"""
         sclass, args, stypes = self.sprite_constr[key]
@@ -286,6 +334,10 @@ class BasicGame(object):
         s.stypes = stypes
         self.sprite_groups[key].append(s)
         self.num_sprites += 1
+        if isinstance(s, Avatar):
+            self._avatars.append(s)
+        if self._static_keys is not None and key in self._static_keys:
+            self._staticsChanged()
         return s
 
     def _initScreen(self, size, headless):
@@ -293,14 +345,20 @@ class BasicGame(object):
             os.environ["SDL_VIDEODRIVER"] = "dummy"
             pygame.display.init()
             self.screen = pygame.display.set_mode((1, 1))
-            self.background = pygame.Surface(size)
+            # in true color: the dummy display's format is 8-bit, with an all-black palette
+            self.background = pygame.Surface(size, 0, 32)
+            # the background without the static sprites
+            self._background_color = (0, 0, 0)
         else:
             from ontology import LIGHTGRAY
             pygame.init()
             self.screen = pygame.display.set_mode(size)
-            self.background = pygame.Surface(size)
+            self.background = pygame.Surface(size, 0, 32).convert()
             self.background.fill(LIGHTGRAY)
+            self._background_color = LIGHTGRAY
             self.screen.blit(self.background, (0, 0))
+        self._staticsChanged()
+        self._background_onscreen = False
 
     def __iter__(self):
         """ Iterator over all sprites (ordered) """
@@ -311,6 +369,29 @@ class BasicGame(object):
             for s in self.sprite_groups[key]:
                 yield s
 
+    def _updateSprites(self, prof, t0):
+        """ Update all sprites (ordered); the profiler is charged once per sprite group
+        (of a single class each), not per sprite. Returns the time of the last lap. """
+        for key in self.sprite_order:
+            if key not in self.sprite_groups:
+                # abstract type
+                continue
+            ss = self.sprite_groups[key]
+            for s in ss:
+                s.update(self)
+            if len(ss) > 0:
+                t0 = prof.lap('update;' + ss[0].__class__.__name__, t0)
+        return t0
+
+    def _dynamicSprites(self):
+        """ Iterator over the sprites that are not part of the pre-rendered background (ordered) """
+        static = self._static_keys or ()
+        for key in self.sprite_order:
+            if key in static or key not in self.sprite_groups:
+                continue
+            for s in self.sprite_groups[key]:
+                yield s
+
     def numSprites(self, key):
         """ Abstract sprite groups are computed on demand only """
         deleted = len([s for s in self.kill_list if key in s.stypes])
@@ -326,12 +407,8 @@ class BasicGame(object):
             return [s for s in self if key in s.stypes and s not in self.kill_list]
 
     def getAvatars(self):
-        """ The currently alive avatar(s) """
-        res = []
-        for ss in self.sprite_groups.values():
-            if ss and isinstance(ss[0], Avatar):
-                res.extend([s for s in ss if s not in self.kill_list])
-        return res
+        """ The currently alive avatar(s) (the list is shared, do not modify it) """
+        return self._avatars
 
     ignoredattributes = ['stypes',
                              'name',
@@ -396,6 +473,8 @@ class BasicGame(object):
         self.reset()
         self.score = fs['score']
         self.ended = fs['ended']
+        self._avatars = [s for s in self._avatars if s.name not in fs['objects']]
+        self._sprite_generation += 1
         for key, ss in fs['objects'].iteritems():
             self.sprite_groups[key] = []
             for pos, attrs in ss.iteritems():
@@ -412,94 +491,315 @@ class BasicGame(object):
                         s.__setattr__(a, val)
 
     def _clearAll(self, onscreen=True):
+        static = self._static_keys or ()
         for s in set(self.kill_list):
             if onscreen:
                 s._clear(self.screen, self.background, double=True)
             self.sprite_groups[s.name].remove(s)
+            if s.name in static:
+                self._staticsChanged()
         if onscreen:
-            for s in self:
+            for s in self._dynamicSprites():
                 s._clear(self.screen, self.background)
         self.kill_list = []
 
     def _drawAll(self):
-        for s in self:
+        if self._static_dirty:
+            self._renderBackground()
+        if not self._background_onscreen:
+            VGDLSprite.dirtyrects.append(self.screen.blit(self.background, (0, 0)))
+            self._background_onscreen = True
+        for s in self._dynamicSprites():
             s._draw(self)
 
+    def _staticLayerKeys(self):
+        """ The sprite types that can be pre-rendered into the background: the static ones
+        that come before any non-static one in the drawing order (so overlaps look the same). """
+        parents = set()
+        for _, _, stypes in self.sprite_constr.itervalues():
+            parents.update(stypes[:-1])
+        res = set()
+        for key in self.sprite_order:
+            if key in parents or key not in self.sprite_constr:
+                # abstract type
+                continue
+            if not self.sprite_constr[key][0].is_static:
+                break
+            res.add(key)
+        return res
+
+    def _staticsChanged(self):
+        """ The pre-rendered static sprites (on the background, and for render_array) are outdated. """
+        self._static_dirty = True
+        self._frame_background = None
+
+    def _drawStatics(self, surface):
+        """ Fill a surface with the background color, and draw all the static sprites onto it. """
+        if self._static_keys is None:
+            self._static_keys = self._staticLayerKeys()
+        surface.fill(self._background_color)
+        screen, ndirty = self.__dict__.get('screen'), len(VGDLSprite.dirtyrects)
+        # the sprites draw themselves on the game's screen
+        self.screen = surface
+        try:
+            for key in self.sprite_order:
+                if key in self._static_keys and key in self.sprite_groups:
+                    for s in self.sprite_groups[key]:
+                        s._draw(self)
+        finally:
+            if screen is None:
+                del self.screen
+            else:
+                self.screen = screen
+            del VGDLSprite.dirtyrects[ndirty:]
+
+    def _renderBackground(self):
+        """ Draw all the static sprites onto the (plain) background. """
+        self._drawStatics(self.background)
+        self._static_dirty = False
+        self._background_onscreen = False
+
+    def render_array(self, out=None):
+        """ The current frame as a (height, width, 3) uint8 array, drawn offscreen
+        (no display is needed, and the screen is left alone).
+
+        The sprites are drawn directly into the given output array if it is C-contiguous,
+        otherwise the frame is copied into it. Without one, the game's own buffer is returned,
+        which is overwritten by the next call. """
+        from numpy import zeros, uint8
+        w, h = self.screensize
+        if out is not None and out.shape == (h, w, 3) and out.dtype == uint8 and out.flags['C_CONTIGUOUS']:
+            frame, surface = out, pygame.image.frombuffer(out, (w, h), 'RGB')
+        else:
+            if self._frame is None or self._frame.shape != (h, w, 3):
+                self._frame = zeros((h, w, 3), uint8)
+                # a surface drawing into the array
+                self._frame_surface = pygame.image.frombuffer(self._frame, (w, h), 'RGB')
+            frame, surface = self._frame, self._frame_surface
+
+        screen, ndirty = self.__dict__.get('screen'), len(VGDLSprite.dirtyrects)
+        # the sprites draw themselves on the game's screen
+        self.screen = surface
+        try:
+            if self._frame_background is None or self._frame_background.get_size() != (w, h):
+                # independent of the screen's background (whose pixel format is the display's),
+                # in the pixel format of the frames, for fast blitting
+                self._frame_background = pygame.Surface((w, h), 0, surface)
+                self._drawStatics(self._frame_background)
+            surface.blit(self._frame_background, (0, 0))
+            for s in self._dynamicSprites():
+                s._draw(self)
+        finally:
+            if screen is None:
+                del self.screen
+            else:
+                self.screen = screen
+            del VGDLSprite.dirtyrects[ndirty:]
+        if out is not None and frame is not out:
+            out[...] = frame
+            return out
+        return frame
+
+    def render_tiles(self, scale=1, out=None):
+        """ A compact symbolic rendering, without any drawing: one square of scale x scale pixels
+        per grid cell, in the color of the topmost sprite type on it (in the drawing order),
+        as a (height * scale, width * scale, 3) uint8 array. Sprites are placed by their centers.
+
+        The colors per sprite type are in tile_colors; types without one get the color
+        of their first sprite. """
+        from numpy import array, zeros, maximum, uint8, intp
+        bs = self.block_size
+        w, h = self.screensize[0] // bs, self.screensize[1] // bs
+        palette = [getattr(self, '_background_color', (0, 0, 0))]
+        centers = []
+        layers = []
+        for key in self.sprite_order:
+            ss = self.sprite_groups.get(key)
+            if not ss:
+                continue
+            if key not in self.tile_colors:
+                self.tile_colors[key] = tuple(ss[0].color)
+            palette.append(self.tile_colors[key])
+            centers.extend(s.rect.center for s in ss)
+            layers.extend([len(palette) - 1] * len(ss))
+
+        # the topmost layer per cell (0 for the background)
+        zbuf = zeros((h, w), intp)
+        if len(centers) > 0:
+            centers = array(centers) // bs
+            layers = array(layers, intp)
+            inside = (centers[:, 0] >= 0) & (centers[:, 0] < w) & (centers[:, 1] >= 0) & (centers[:, 1] < h)
+            maximum.at(zbuf, (centers[inside, 1], centers[inside, 0]), layers[inside])
+        if scale > 1:
+            zbuf = zbuf.repeat(scale, 0).repeat(scale, 1)
+        if out is None:
+            out = zeros((h * scale, w * scale, 3), uint8)
+        return array(palette, uint8).take(zbuf, axis=0, out=out)
+
+    def enableCollisionStats(self, enabled=True):
+        """ Start (or stop) counting, per collision rule, the pairs tested, overlaps,
+        effects and time spent. Returns the statistics object (reset it per episode). """
+        if enabled:
+            from instrumentation import CollisionStats
+            self.collision_stats = CollisionStats(self.collision_eff)
+        else:
+            self.collision_stats = None
+        return self.collision_stats
+
+    def enableProfiling(self, enabled=True, filename=None):
+        """ Start (or stop) timing the phases of every tick. Returns the TickProfiler.
+        By default, the collapsed stacks are appended at exit to the file named
+        by the VGDL_PROFILE environment variable (unless it is set to 1). """
+        if enabled:
+            from instrumentation import TickProfiler
+            if filename is None and os.environ.get('VGDL_PROFILE', '1') != '1':
+                filename = os.environ['VGDL_PROFILE']
+            self.profiler = TickProfiler(filename)
+        else:
+            self.profiler = NullProfiler()
+        return self.profiler
+
+    def _profileIfRequested(self):
+        """ Games that are played get profiled if the VGDL_PROFILE environment variable is set. """
+        if os.environ.get('VGDL_PROFILE') and not self.profiler.enabled:
+            self.enableProfiling()
+
     def _updateCollisionDict(self, changedsprite):
         for key in changedsprite.stypes:
             if key in self.lastcollisions:
                 del self.lastcollisions[key]
+                stats = self.collision_stats
+                if stats is not None and stats.current is not None:
+                    stats.invalidations[stats.current] += 1
 
     def _eventHandling(self):
+        stats = self.collision_stats
+        if stats is not None:
+            return self._countedEventHandling(stats)
         self.lastcollisions = {}
         ss = self.lastcollisions
         for g1, g2, effect, kwargs in self.collision_eff:
-            # build the current sprite lists (if not yet available)
-            for g in [g1, g2]:
-                if g not in ss:
-                    if g in self.sprite_groups:
-                        tmp = self.sprite_groups[g]
-                    else:
-                        tmp = []
-                        for key in self.sprite_groups:
-                            v = self.sprite_groups[key]
-                            if v and g in v[0].stypes:
-                                tmp.extend(v)
-                    ss[g] = (tmp, len(tmp))
-
-            # special case for end-of-screen
-            if g2 == "EOS":
-                ss1, l1 = ss[g1]
-                for s1 in ss1:
-                    if not pygame.Rect((0, 0), self.screensize).contains(s1.rect):
-                        effect(s1, None, self, **kwargs)
-                continue
+            self._handleRule(ss, g1, g2, effect, kwargs)
 
-            # iterate over the shorter one
+    def _countedEventHandling(self, stats):
+        from time import time
+        self.lastcollisions = {}
+        ss = self.lastcollisions
+        stats.ticks += 1
+        for ri, (g1, g2, effect, kwargs) in enumerate(self.collision_eff):
+            stats.current = ri
+            start = time()
+            candidates, overlaps, effects = self._handleRule(ss, g1, g2, effect, kwargs)
+            stats.time[ri] += time() - start
+            stats.candidates[ri] += candidates
+            stats.overlaps[ri] += overlaps
+            stats.effects[ri] += effects
+        stats.current = None
+
+    def _handleRule(self, ss, g1, g2, effect, kwargs):
+        """ Apply one collision rule, returns the number of sprite pairs tested,
+        of overlapping ones, and of effects fired. """
+        # build the current sprite lists (if not yet available)
+        for g in [g1, g2]:
+            if g not in ss:
+                if g in self.sprite_groups:
+                    tmp = self.sprite_groups[g]
+                else:
+                    tmp = []
+                    for key in self.sprite_groups:
+                        v = self.sprite_groups[key]
+                        if v and g in v[0].stypes:
+                            tmp.extend(v)
+                ss[g] = (tmp, len(tmp))
+
+        # special case for end-of-screen
+        if g2 == "EOS":
             ss1, l1 = ss[g1]
-            ss2, l2 = ss[g2]
-            if l1 < l2:
-                shortss, longss, switch = ss1, ss2, False
-            else:
-                shortss, longss, switch = ss2, ss1, True
-
-            # score argument is not passed along to the effect function
-            score = 0
-            if 'scoreChange' in kwargs:
-                kwargs = kwargs.copy()
-                score = kwargs['scoreChange']
-                del kwargs['scoreChange']
-
-            # do collision detection
-            for s1 in shortss:
-                for ci in s1.rect.collidelistall(longss):
-                    s2 = longss[ci]
-                    if s1 == s2:
-                        continue
-                    # deal with the collision effects
-                    if score:
-                        self.score += score
-                    if switch:
-                        # CHECKME: this is not a bullet-proof way, but seems to work
-                        if s2 not in self.kill_list:
-                            effect(s2, s1, self, **kwargs)
-                    else:
-                        # CHECKME: this is not a bullet-proof way, but seems to work
-                        if s1 not in self.kill_list:
-                            effect(s1, s2, self, **kwargs)
-
-    def startGame(self, headless, persist_movie):
+            overlaps = 0
+            for s1 in ss1:
+                if not pygame.Rect((0, 0), self.screensize).contains(s1.rect):
+                    effect(s1, None, self, **kwargs)
+                    overlaps += 1
+            return len(ss1), overlaps, overlaps
+
+        # iterate over the shorter one
+        ss1, l1 = ss[g1]
+        ss2, l2 = ss[g2]
+        if l1 < l2:
+            shortss, longss, switch = ss1, ss2, False
+        else:
+            shortss, longss, switch = ss2, ss1, True
+
+        # score argument is not passed along to the effect function
+        score = 0
+        if 'scoreChange' in kwargs:
+            kwargs = kwargs.copy()
+            score = kwargs['scoreChange']
+            del kwargs['scoreChange']
+
+        # do collision detection
+        candidates, overlaps, effects = 0, 0, 0
+        for s1 in shortss:
+            candidates += len(longss)
+            for ci in s1.rect.collidelistall(longss):
+                s2 = longss[ci]
+                if s1 == s2:
+                    continue
+                overlaps += 1
+                # deal with the collision effects
+                if score:
+                    self.score += score
+                if switch:
+                    # CHECKME: this is not a bullet-proof way, but seems to work
+                    if s2 not in self.kill_list:
+                        effect(s2, s1, self, **kwargs)
+                        effects += 1
+                else:
+                    # CHECKME: this is not a bullet-proof way, but seems to work
+                    if s1 not in self.kill_list:
+                        effect(s1, s2, self, **kwargs)
+                        effects += 1
+        return candidates, overlaps, effects
+
+    def startRecording(self, filename=None, outdir='./videos/', **kwargs):
+        """ Record a video of the game from the next frame on (see MovieRecorder for the options,
+        e.g. codec), into a file named after the game's id by default. """
+        from recording import MovieRecorder
+        if filename is None:
+            if not hasattr(self, 'uiud'):
+                self.uiud = uuid.uuid4()
+            filename = os.path.join(outdir, str(self.uiud) + '.mp4')
+        self.recorder = MovieRecorder(filename, self.screensize, **kwargs)
+        return self.recorder
+
+    def stopRecording(self):
+        """ Finish the video, returns its file name. """
+        if self.recorder is None:
+            return None
+        recorder, self.recorder = self.recorder, None
+        self.video_file = recorder.close()
+        return self.video_file
+
+    def startGame(self, headless, persist_movie, movie_dir='./videos/'):
         self._initScreen(self.screensize, headless)
         pygame.display.flip()
         self.reset()
         clock = pygame.time.Clock()
-
+        if persist_movie:
+            print "Recording movie"
+            self.startRecording(outdir=movie_dir)
+
+        self._profileIfRequested()
+        prof = self.profiler
+        # one episode
+        prof.reset()
         win = False
-        i = 0
         while not self.ended:
             clock.tick(self.frame_rate)
+            t0 = prof.startTick()
             self.time += 1
             self._clearAll()
+            t0 = prof.lap('clear', t0)
 
             # gather events
             pygame.event.pump()
@@ -514,35 +814,33 @@ class BasicGame(object):
                     pygame.display.flip()
                 if self.keystate[K_1]:
                     self._lastsaved = self.getFullState()
+            t0 = prof.lap('input', t0)
 
             # termination criteria
             for t in self.terminations:
                 self.ended, win = t.isDone(self)
+                t0 = prof.lap('terminations;' + t.__class__.__name__, t0)
                 if self.ended:
                     break
             # update sprites
-            for s in self:
-                s.update(self)
+            t0 = self._updateSprites(prof, t0)
             # handle collision effects
             self._eventHandling()
+            t0 = prof.lap('eventHandling', t0)
             self._drawAll()
+            t0 = prof.lap('draw', t0)
             pygame.display.update(VGDLSprite.dirtyrects)
+            t0 = prof.lap('display', t0)
 
-            #if(headless):
-            if(persist_movie):
-                tmp_dir = "./temp/"
-                tmpl = '{tmp_dir}%09d-{name}-{g_id}.png'.format(i, tmp_dir=tmp_dir, name="VGDL-GAME", g_id=self.uiud)
-                pygame.image.save(self.screen, tmpl % i)
-
-                i += 1
+            if self.recorder is not None:
+                self.recorder.addFrame(self)
             VGDLSprite.dirtyrects = []
+            prof.lap('movie', t0)
+            prof.endTick()
 
-        if(persist_movie):
-            print "Creating Movie"
-            self.video_file = "./videos/" + str(self.uiud) + ".mp4"
-            subprocess.call(["ffmpeg", "-y", "-r", "30", "-b", "800", "-i", tmpl, self.video_file])
-            [os.remove(f) for f in glob.glob(tmp_dir + "*" + str(self.uiud) + "*")]
-
+        if self.recorder is not None:
+            print "Finishing movie"
+            self.stopRecording()
 
         if win:
             # winning a game always gives a positive score.
@@ -551,6 +849,7 @@ class BasicGame(object):
             print "Game won, with score %s" % self.score
         else:
             print "Game lost. Score=%s" % self.score
+        prof.report()
 
         # pause a few frames for the player to see the final screen.
         pygame.time.wait(50)
@@ -559,28 +858,42 @@ class BasicGame(object):
     def getPossibleActions(self):
         return self.getAvatars()[0].declare_possible_actions()
 
-    def startGameExternalPlayer(self, headless, persist_movie, movie_dir):
+    def startGameExternalPlayer(self, headless, persist_movie, movie_dir='./videos/'):
+        """ The game is then played by calling tick; the recording (if any) stops when it ends. """
         self._initScreen(self.screensize, headless)
         pygame.display.flip()
         self.reset()
         self.clock = pygame.time.Clock()
-        self.tmp_dir = movie_dir
-        self.video_tmpl = '{tmp_dir}%09d-{name}-{g_id}.png'.format(self.time, tmp_dir=self.tmp_dir, name="VGDL-GAME", g_id=self.uiud)
+        if persist_movie:
+            self.startRecording(outdir=movie_dir)
+        self._profileIfRequested()
 
     def tick(self, action, headless=True, persist_movie=False):
 
         win = False
 
+        prof = self.profiler
+        t0 = prof.startTick()
+
         #self.clock.tick(self.frame_rate)
         self.time += 1
         if not headless:
             self._clearAll()
+            t0 = prof.lap('clear', t0)
 
         # gather events
-        pygame.event.pump()
-        self.keystate = list(pygame.key.get_pressed())
+        if pygame.display.get_init():
+            pygame.event.pump()
+            self.keystate = list(pygame.key.get_pressed())
+        else:
+            # played without a display (see render_array): no keyboard
+            from pygame.locals import K_LAST
+            self.keystate = [0] * K_LAST
 
-        self.keystate[action] = 1
+        # no key pressed if the action is None
+        if action is not None:
+            self.keystate[action] = 1
+        t0 = prof.lap('input', t0)
 
         # load/save handling
         #if self.load_save_enabled:
@@ -595,20 +908,30 @@ class BasicGame(object):
         # termination criteria
         for t in self.terminations:
             self.ended, win = t.isDone(self)
+            t0 = prof.lap('terminations;' + t.__class__.__name__, t0)
             if self.ended:
+                if self.recorder is not None:
+                    self.stopRecording()
+                prof.endTick()
                 return win, self.score
             # update sprites
             #print action
 
-        for s in self:
-            s.update(self)
+        t0 = self._updateSprites(prof, t0)
 
         # handle collision effects
         self._eventHandling()
+        t0 = prof.lap('eventHandling', t0)
         if not headless:
             self._drawAll()
+            t0 = prof.lap('draw', t0)
             pygame.display.update(VGDLSprite.dirtyrects)
             VGDLSprite.dirtyrects = []
+            t0 = prof.lap('display', t0)
+        if self.recorder is not None:
+            self.recorder.addFrame(self)
+            prof.lap('movie', t0)
+        prof.endTick()
 
         return None, None
 
@@ -630,6 +953,13 @@ class VGDLSprite(object):
     physicstype = None
     shrinkfactor = 0
 
+    # pre-rendered images of the non-static sprites, shared by all games (least recently used last)
+    _surface_cache = OrderedDict()
+    surface_cache_size = 1000
+    surface_margin = 2
+    # transparent in the pre-rendered images (none of the colors has a 255 and a 0 component)
+    surface_colorkey = (255, 0, 255)
+
     def __init__(self, pos, size=(10, 10), color=None, speed=None, cooldown=None, physicstype=None, **kwargs):
         from ontology import GridPhysics
         self.rect = pygame.Rect(pos, size)
@@ -678,28 +1008,64 @@ class VGDLSprite(object):
         return (self.rect[0] - self.lastrect[0], self.rect[1] - self.lastrect[1])
 
     def _draw(self, game):
+        if self.is_static:
+            r = self._drawShape(game, game.screen, self.rect)
+        else:
+            r = self._drawCached(game)
+        VGDLSprite.dirtyrects.append(r)
+
+    def _drawShape(self, game, screen, rect):
+        """ Draw the sprite onto a surface, within the given rectangle (normally its own).
+        Returns the area that changed. """
         from ontology import LIGHTGREEN
-        screen = game.screen
         if self.shrinkfactor != 0:
-            shrunk = self.rect.inflate(-self.rect.width * self.shrinkfactor,
-                                       -self.rect.height * self.shrinkfactor)
+            shrunk = rect.inflate(-rect.width * self.shrinkfactor,
+                                  -rect.height * self.shrinkfactor)
         else:
-            shrunk = self.rect
+            shrunk = rect
 
         if self.is_avatar:
             rounded = roundedPoints(shrunk)
             pygame.draw.polygon(screen, self.color, rounded)
             pygame.draw.lines(screen, LIGHTGREEN, True, rounded, 2)
-            r = self.rect.copy()
+            r = rect.copy()
         elif not self.is_static:
             rounded = roundedPoints(shrunk)
             pygame.draw.polygon(screen, self.color, rounded)
-            r = self.rect.copy()
+            r = rect.copy()
         else:
             r = screen.fill(self.color, shrunk)
         if self.resources:
             self._drawResources(game, screen, shrunk)
-        VGDLSprite.dirtyrects.append(r)
+        return r
+
+    def _drawKey(self, game):
+        """ Everything the appearance of the sprite depends on. """
+        res = (self.__class__, self.is_avatar, tuple(self.color), self.rect.size, self.shrinkfactor)
+        if self.resources:
+            res += tuple((r, game.resources_colors[r], self.resources[r] / float(game.resources_limits[r]))
+                         for r in sorted(self.resources.keys()))
+        return res
+
+    def _drawCached(self, game):
+        """ Blit a pre-rendered image of the sprite (drawn with a margin, for the outlines). """
+        cache = VGDLSprite._surface_cache
+        key = self._drawKey(game)
+        surface = cache.pop(key, None)
+        if surface is None:
+            m = self.surface_margin
+            w, h = self.rect.size
+            surface = pygame.Surface((w + 2 * m, h + 2 * m), 0, 32)
+            # the shapes are not antialiased, so a color key blits exactly (on surfaces of any depth)
+            surface.fill(self.surface_colorkey)
+            surface.set_colorkey(self.surface_colorkey, pygame.RLEACCEL)
+            self._drawShape(game, surface, pygame.Rect(m, m, w, h))
+            if len(cache) >= self.surface_cache_size:
+                # evict the least recently used one
+                cache.popitem(last=False)
+        cache[key] = surface
+        game.screen.blit(surface, (self.rect.left - self.surface_margin, self.rect.top - self.surface_margin))
+        return self.rect.copy()
 
     def _drawResources(self, game, screen, rect):
         """ Draw progress bars on the bottom third of the sprite """
@@ -756,7 +1122,83 @@ class Termination(object):
     def isDone(self, game):
         """ returns whether the game is over, with a win/lose flag """
         from pygame.locals import K_ESCAPE, QUIT
-        if game.keystate[K_ESCAPE] or pygame.event.peek(QUIT):
+        if game.keystate[K_ESCAPE] or (pygame.display.get_init() and pygame.event.peek(QUIT)):
             return True, False
         else:
             return False, None
+
+
+def _referenceFrame(game):
+    """ The current frame drawn the plain way, every sprite in order onto a true-color surface
+    (no pre-rendered background, no cached images), as a (height, width, 3) uint8 array. """
+    surface = pygame.Surface(game.screensize, 0, 32)
+    surface.fill(getattr(game, '_background_color', (0, 0, 0)))
+    for s in game:
+        s._drawShape(game, surface, s.rect)
+    return pygame.surfarray.array3d(surface).swapaxes(0, 1)
+
+
+def testStaticBackground(steps=100):
+    """ Play a few games at random, drawing onto a true-color screen (but with the headless display),
+    and check that every frame is exactly the one drawn sprite by sprite. """
+    from random import choice
+    from examples.gridphysics.aliens import aliens_game, aliens_level
+    from examples.gridphysics.frogs import frog_game, frog_level
+    from examples.gridphysics.mazes import polarmaze_game, maze_level_2
+    from examples.gridphysics.zelda import zelda_game, zelda_level
+    for name, game_str, map_str in [('polarmaze', polarmaze_game, maze_level_2),
+                                    ('aliens', aliens_game, aliens_level),
+                                    ('frogs', frog_game, frog_level),
+                                    ('zelda', zelda_game, zelda_level)]:
+        g = VGDLParser().parseGame(game_str)
+        g.buildLevel(map_str)
+        g._initScreen(g.screensize, headless=True)
+        # a stand-in for a true-color display
+        g.screen = pygame.Surface(g.screensize, 0, 32)
+        actions = [None] + sorted(g.getPossibleActions().values())
+        frames = 0
+        while frames < steps:
+            g.tick(choice(actions), headless=False)
+            if g.ended:
+                break
+            frame = pygame.surfarray.array3d(g.screen).swapaxes(0, 1)
+            assert (frame == _referenceFrame(g)).all(), 'Frame %d of %s differs' % (frames, name)
+            frames += 1
+        VGDLSprite.dirtyrects = []
+        print '%-10s %4d frames, %d static sprite types' % (name, frames, len(g._static_keys))
+
+
+def testRenderArray(steps=100):
+    """ Play a few games at random, and check that every offscreen frame is exactly the one
+    drawn sprite by sprite: with or without an own (headless) screen, into the game's buffer
+    or into given arrays. """
+    from random import choice
+    from numpy import zeros, uint8
+    from examples.gridphysics.aliens import aliens_game, aliens_level
+    from examples.gridphysics.mazes import polarmaze_game, maze_level_2
+    from examples.gridphysics.zelda import zelda_game, zelda_level
+    for name, game_str, map_str in [('polarmaze', polarmaze_game, maze_level_2),
+                                    ('aliens', aliens_game, aliens_level),
+                                    ('zelda', zelda_game, zelda_level)]:
+        for screen in [True, False]:
+            g = VGDLParser().parseGame(game_str)
+            g.buildLevel(map_str)
+            if screen:
+                g._initScreen(g.screensize, headless=True)
+            w, h = g.screensize
+            outs = [None, zeros((h, w, 3), uint8), zeros((w, h, 3), uint8).swapaxes(0, 1)]
+            actions = [None] + sorted(g.getPossibleActions().values())
+            frames = 0
+            while frames < steps:
+                g.tick(choice(actions), headless=True)
+                if g.ended:
+                    break
+                frame = g.render_array(outs[frames % len(outs)])
+                assert (frame == _referenceFrame(g)).all(), 'Frame %d of %s differs' % (frames, name)
+                frames += 1
+            print '%-10s %4d frames, %s screen' % (name, frames, 'own' if screen else 'no')
+
+
+if __name__ == '__main__':
+    testStaticBackground()
+    testRenderArray()
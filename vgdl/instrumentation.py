@@ -0,0 +1,234 @@
+'''
+Optional instrumentation of the game loop, to find out where the time goes.
+
+Collision statistics: per rule of the InteractionSet (in execution order), how many sprite pairs
+were tested, how many of them overlapped, how many effects were fired, the time spent
+on the rule, and how often the rule's effects invalidated a cached sprite group.
+
+Enable them with BasicGame.enableCollisionStats(); when they are disabled, the game loop
+only checks for them once per tick.
+
+Tick profiling: the wall time of each phase of the game loop (reading the input,
+terminations, sprite updates per sprite class, collision handling, clearing, drawing,
+updating the display), aggregated over the ticks of an episode, with percentiles.
+It can be dumped in the collapsed-stack format used by flame graph tools.
+
+Enable it with BasicGame.enableProfiling(), or for every game that is played (with startGame or
+startGameExternalPlayer) by setting the environment variable VGDL_PROFILE: to 1, or to the name
+of a file that the collapsed stacks are appended to at exit. When it is disabled, the game
+loop calls a profiler that does nothing.
+'''
+
+import csv
+import json
+import atexit
+from StringIO import StringIO
+from timeit import default_timer
+from collections import defaultdict
+from numpy import percentile
+
+
+class CollisionStats(object):
+    """ Counters per collision rule, accumulated over ticks until reset (e.g. per episode). """
+
+    fields = ['candidates', 'overlaps', 'effects', 'time', 'invalidations']
+
+    def __init__(self, collision_eff):
+        self.rules = [(g1, g2, effect.__name__) for g1, g2, effect, _ in collision_eff]
+        # the rule being processed (its effects are charged with the invalidations)
+        self.current = None
+        self.reset()
+
+    def reset(self):
+        self.ticks = 0
+        for f in self.fields:
+            if f == 'time':
+                setattr(self, f, [0.] * len(self.rules))
+            else:
+                setattr(self, f, [0] * len(self.rules))
+
+    def rows(self):
+        """ One dictionary per rule. """
+        res = []
+        for ri, (g1, g2, effect) in enumerate(self.rules):
+            row = {'rule': ri, 'sprite1': g1, 'sprite2': g2, 'effect': effect}
+            for f in self.fields:
+                row[f] = getattr(self, f)[ri]
+            res.append(row)
+        return res
+
+    def toJSON(self, filename=None):
+        """ Returns the statistics as a JSON string, optionally also writing it to a file. """
+        res = json.dumps({'ticks': self.ticks, 'rules': self.rows()}, indent=1)
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write(res)
+        return res
+
+    def toCSV(self, filename=None):
+        """ Returns the statistics as CSV (one line per rule), optionally also writing it to a file. """
+        out = StringIO()
+        w = csv.DictWriter(out, ['rule', 'sprite1', 'sprite2', 'effect'] + self.fields)
+        w.writeheader()
+        w.writerows(self.rows())
+        res = out.getvalue()
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write(res)
+        return res
+
+    def report(self, top=10):
+        """ Print the most expensive rules. """
+        print 'Collision statistics over', self.ticks, 'ticks:'
+        print '%4s %-35s %10s %10s %10s %10s %8s' % ('rule', '', 'candidates', 'overlaps', 'effects',
+                                                     'invalid.', 'ms')
+        for row in sorted(self.rows(), key=lambda r:-r['time'])[:top]:
+            desc = '%(sprite1)s %(sprite2)s > %(effect)s' % row
+            print '%4d %-35s %10d %10d %10d %10d %8.1f' % (row['rule'], desc[:35], row['candidates'],
+                                                           row['overlaps'], row['effects'],
+                                                           row['invalidations'], row['time'] * 1000)
+
+
+# the profilers that append their collapsed stacks to a file at exit
+_dumped_profilers = []
+
+
+def _dumpProfilers():
+    for prof in _dumped_profilers:
+        prof.dump()
+
+
+class NullProfiler(object):
+    """ Stands in for a TickProfiler when profiling is disabled: all calls do nothing. """
+
+    enabled = False
+    ticks = 0
+
+    def reset(self):
+        pass
+
+    def startTick(self):
+        return None
+
+    def lap(self, phase, since):
+        return since
+
+    def endTick(self):
+        pass
+
+    def report(self, top=20):
+        pass
+
+
+class TickProfiler(object):
+    """ Wall time per phase of each tick. Phases are named like collapsed stacks,
+    with sub-phases separated by semicolons (e.g. 'update;Missile'). """
+
+    enabled = True
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        if filename is not None:
+            # one exit hook for all of them
+            if len(_dumped_profilers) == 0:
+                atexit.register(_dumpProfilers)
+            _dumped_profilers.append(self)
+        self.reset()
+
+    def reset(self):
+        # per phase, the durations in the ticks it occurred in
+        self.samples = defaultdict(list)
+        self.ticks = 0
+        self._current = None
+
+    def startTick(self):
+        """ Returns the current time, from which the first phase is measured. """
+        self._current = defaultdict(float)
+        return default_timer()
+
+    def lap(self, phase, since):
+        """ Charge the time since the given one to a phase, returns the current time. """
+        now = default_timer()
+        self._current[phase] += now - since
+        return now
+
+    def endTick(self):
+        self.ticks += 1
+        for phase, duration in self._current.iteritems():
+            self.samples[phase].append(duration)
+        self._current = None
+
+    def summary(self):
+        """ Per phase (the most expensive first): the number of ticks it occurred in, the total,
+        mean, median, 90th and 99th percentile and maximal time per tick, in seconds. """
+        res = []
+        for phase, durations in self.samples.iteritems():
+            p50, p90, p99 = percentile(durations, [50, 90, 99])
+            res.append({'phase': phase, 'count': len(durations), 'total': sum(durations),
+                        'mean': sum(durations) / len(durations), 'p50': p50, 'p90': p90, 'p99': p99,
+                        'max': max(durations)})
+        return sorted(res, key=lambda r:-r['total'])
+
+    def report(self, top=20):
+        print 'Tick profile over', self.ticks, 'ticks (ms per tick):'
+        print '%-35s %6s %9s %8s %8s %8s %8s %8s' % ('phase', 'ticks', 'total', 'mean', 'p50', 'p90', 'p99', 'max')
+        for r in self.summary()[:top]:
+            print '%-35s %6d %9.1f %8.3f %8.3f %8.3f %8.3f %8.3f' % (r['phase'][:35], r['count'], r['total'] * 1000,
+                                                                  r['mean'] * 1000, r['p50'] * 1000,
+                                                                  r['p90'] * 1000, r['p99'] * 1000,
+                                                                  r['max'] * 1000)
+
+    def toCollapsed(self, filename=None, append=False):
+        """ The total time per phase, as collapsed stacks (in microseconds), one line per phase,
+        optionally also written to a file. """
+        lines = ['tick;%s %d' % (phase, int(round(sum(durations) * 1e6)))
+                 for phase, durations in sorted(self.samples.iteritems())]
+        res = ''.join(l + '\n' for l in lines)
+        if filename is not None:
+            with open(filename, 'a' if append else 'w') as f:
+                f.write(res)
+        return res
+
+    def dump(self):
+        """ Append the collapsed stacks to the file given on construction. """
+        if self.ticks > 0:
+            self.toCollapsed(self.filename, append=True)
+
+
+def testCollisionStats():
+    from core import VGDLParser
+    from examples.gridphysics.aliens import aliens_game, aliens_level
+    from pygame.locals import K_SPACE
+    g = VGDLParser().parseGame(aliens_game)
+    g.buildLevel(aliens_level)
+    g._initScreen(g.screensize, headless=True)
+    stats = g.enableCollisionStats()
+    for _ in range(300):
+        win, _ = g.tick(K_SPACE)
+        g._clearAll(False)
+        if win is not None:
+            break
+    stats.report()
+    print stats.toCSV()
+
+
+def testTickProfiler():
+    from core import VGDLParser
+    from examples.gridphysics.aliens import aliens_game, aliens_level
+    from pygame.locals import K_SPACE
+    g = VGDLParser().parseGame(aliens_game)
+    g.buildLevel(aliens_level)
+    g._initScreen(g.screensize, headless=True)
+    prof = g.enableProfiling()
+    for _ in range(300):
+        win, _ = g.tick(K_SPACE)
+        g._clearAll(False)
+        if win is not None:
+            break
+    prof.report()
+    print prof.toCollapsed()
+
+
+if __name__ == '__main__':
+    testCollisionStats()
+    testTickProfiler()
@@ -7,7 +7,7 @@ Wrappers for games to interface them with artificial players.
 These are based on the PyBrain RL framework of Environment and Task classes.
 '''
 
-from numpy import zeros
+from numpy import zeros, asarray
 import pygame
 
 from pybrain.rl.environments.environment import Environment
@@ -58,10 +58,7 @@ class GameEnvironment(Environment, StateObsHandler):
     def getSensors(self, state=None):
         if state is None:
             state = self.getState()
-        if self.orientedAvatar:
-            pos = (state[0], state[1])
-        else:
-            pos = state
+        pos = (state[0], state[1])
         res = zeros(self.outdim)
         ns = [pos] + self._stateNeighbors(state)
         for i, n in enumerate(ns):
@@ -69,6 +66,19 @@ class GameEnvironment(Environment, StateObsHandler):
             res[i::len(ns)] = os
         return res
 
+    def getSensorsBatch(self, states):
+        """ The observations for many states at once: states is an array (S, 2) of avatar
+        positions, or (S, 3) with the orientation (as index in BASEDIRS) in the last column.
+        Returns an array (outdim, S), where column i is the same as getSensors() of state i. """
+        states = asarray(states, dtype=int)
+        if self.orientedAvatar and states.shape[1] > 2:
+            ns = self._stateNeighborsBatch(states[:, :2], states[:, 2])
+        else:
+            ns = self._stateNeighborsBatch(states[:, :2])
+        obs = self._rawSensorBatch(ns)
+        # same layout as getSensors: all positions for the first type, then the next type, etc.
+        return obs.transpose(0, 2, 1).reshape(-1, len(states)).astype(float)
+
     def setState(self, state):
         if self.visualize and self._avatar is not None:
             self._avatar._clear(self._game.screen, self._game.background)
@@ -91,6 +101,17 @@ class GameEnvironment(Environment, StateObsHandler):
             else:
                 action = argmax(action)
 
+        if self._useTransitionCache(onlyavatar):
+            self._performCachedAction(action)
+        else:
+            self._simulateAction(action, onlyavatar)
+
+        if self.recordingEnabled:
+            self._previous_state = self._last_state
+            self._last_state = self.getState()
+            self._allEvents.append((self._previous_state, action, self._last_state))
+
+    def _simulateAction(self, action, onlyavatar=False):
         # take action and compute consequences
         self._avatar._readMultiActions = lambda *x: [self._actionset[action]]
         self._game._clearAll(self.visualize)
@@ -113,12 +134,6 @@ class GameEnvironment(Environment, StateObsHandler):
             VGDLSprite.dirtyrects = []
             pygame.time.wait(self.actionDelay)
 
-
-        if self.recordingEnabled:
-            self._previous_state = self._last_state
-            self._last_state = self.getState()
-            self._allEvents.append((self._previous_state, action, self._last_state))
-
     def _isDone(self):
         # remember reward if the final state ends the game
         for t in self._game.terminations[1:]:
@@ -133,7 +148,6 @@ class GameEnvironment(Environment, StateObsHandler):
         if init_state is not None:
             self.setState(init_state)
         for a in action_sequence:
-            print a, self.getState()
             if self._isDone()[0]:
                 break
             self.performAction(a)
@@ -0,0 +1,118 @@
+'''
+On-disk cache of converted MDPs, so repeated experiments on the same game and level
+can skip the (expensive) conversion.
+
+Every entry is a directory, named by a hash of everything the conversion
+depends on: the game and level descriptions, the action set, the sampling setup
+(samples per state-action pair), and the observation setup.
+
+It contains the list of states, the sparse transition matrices, the reward vector,
+and optionally the feature map, each array as an uncompressed .npy file,
+so that loading an entry memory-maps the large arrays instead of reading them.
+'''
+
+import os
+import shutil
+import hashlib
+from ast import literal_eval
+from tempfile import gettempdir
+from numpy import array, save, load
+from scipy.sparse import csr_matrix
+
+
+class MDPcache(object):
+    """ A directory of converted MDPs, with least-recently-used eviction. """
+
+    def __init__(self, cachedir=None, maxEntries=100, maxBytes=None):
+        if cachedir is None:
+            cachedir = os.path.join(gettempdir(), 'vgdl_mdps')
+        self.cachedir = cachedir
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+    @staticmethod
+    def key(game_str, map_str, actionset, sampling, observations):
+        """ The identifier of a conversion, or None if the game cannot be identified. """
+        if game_str is None or map_str is None:
+            return None
+        desc = repr((game_str, map_str, list(actionset), sampling, observations))
+        return hashlib.sha1(desc).hexdigest()
+
+    def _dirname(self, key):
+        return os.path.join(self.cachedir, key)
+
+    def load(self, key):
+        """ Returns (states, Ts, R, fMap), or None if the entry is not in the cache.
+        The arrays of the transition matrices, the rewards and the feature map are memory-mapped
+        (read-only), so their pages are only read from disk when accessed. """
+        dn = self._dirname(key)
+        if not os.path.isdir(dn):
+            return None
+
+        def mapped(name):
+            return load(os.path.join(dn, name + '.npy'), mmap_mode='r')
+
+        states = [literal_eval(s) for s in load(os.path.join(dn, 'states.npy'))]
+        R = mapped('R')
+        dim = len(R)
+        numactions = len([f for f in os.listdir(dn) if f.endswith('_indptr.npy')])
+        Ts = [csr_matrix((mapped('T%d_data' % ai), mapped('T%d_indices' % ai), mapped('T%d_indptr' % ai)),
+                         shape=(dim, dim))
+              for ai in range(numactions)]
+        if os.path.exists(os.path.join(dn, 'fMap.npy')):
+            fMap = mapped('fMap')
+        else:
+            fMap = None
+        # mark it as recently used
+        os.utime(dn, None)
+        return states, Ts, R, fMap
+
+    def store(self, key, states, Ts, R, fMap=None):
+        arrays = {'states': array([repr(s) for s in states]),
+                  'R': R}
+        for ai, T in enumerate(Ts):
+            T = csr_matrix(T)
+            arrays['T%d_data' % ai] = T.data
+            arrays['T%d_indices' % ai] = T.indices
+            arrays['T%d_indptr' % ai] = T.indptr
+        if fMap is not None:
+            arrays['fMap'] = fMap
+        # write to a temporary directory first, so no one reads a half-written entry
+        dn = self._dirname(key)
+        tmp = '%s.%d.tmp' % (dn, os.getpid())
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for name, a in arrays.iteritems():
+            save(os.path.join(tmp, name + '.npy'), a)
+        try:
+            os.rename(tmp, dn)
+        except OSError:
+            # the same entry was stored meanwhile (by another process)
+            shutil.rmtree(tmp)
+        self._evict()
+
+    def _entries(self):
+        """ All cache entries, the least recently used first. """
+        res = []
+        for f in os.listdir(self.cachedir):
+            dn = os.path.join(self.cachedir, f)
+            if not f.endswith('.tmp') and os.path.isdir(dn):
+                size = sum(os.path.getsize(os.path.join(dn, g)) for g in os.listdir(dn))
+                res.append((os.stat(dn).st_mtime, size, dn))
+        return sorted(res)
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        while len(entries) > 0 and ((self.maxEntries is not None and len(entries) > self.maxEntries)
+                                    or (self.maxBytes is not None and total > self.maxBytes)):
+            _, size, dn = entries.pop(0)
+            shutil.rmtree(dn, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for _, _, dn in self._entries():
+            shutil.rmtree(dn, ignore_errors=True)
@@ -0,0 +1,500 @@
+'''
+Compile the explicit MDP of a static-world grid game directly from its description,
+instead of simulating every (state, action) pair with the game engine.
+
+This covers the games the MDPconverter can handle: a single avatar (from the
+MovingAvatar, OrientedAvatar or RotatingAvatar families, without cooldown),
+and only static other sprites. The avatar's move is derived from its class, then
+the InteractionSet is interpreted on the tile grid, in the same order and with the same
+bookkeeping as BasicGame._eventHandling. Random effects (teleportToExit, windGust,
+slipForward, attractGaze, noisy avatars) are enumerated with their exact probabilities.
+'''
+
+from ontology import BASEDIRS, UP, DOWN, LEFT, RIGHT
+from ontology import MovingAvatar, HorizontalAvatar, VerticalAvatar, OrientedAvatar, OrientedSprite
+from ontology import RotatingAvatar, RotatingFlippingAvatar, NoisyRotatingFlippingAvatar
+from ontology import SpriteCounter, MultiSpriteCounter, Timeout
+from ontology import killSprite, stepBack, undoAll, transformTo, teleportToExit, conveySprite
+from ontology import windGust, slipForward, attractGaze, wrapAround
+from core import Avatar
+from mdpmap import MDPconverter
+
+
+class _Token(object):
+    """ A sprite, reduced to what matters on the grid. """
+
+    def __init__(self, key, stypes, cell, orientation=None, bit=None, avatar=False):
+        self.key = key
+        self.stypes = stypes
+        self.cell = cell
+        self.lastcell = cell
+        self.orientation = orientation
+        # which bit of the presences it corresponds to, if it can be killed
+        self.bit = bit
+        self.avatar = avatar
+
+
+class _Branches(object):
+    """ Makes the random choices of one step: replays a given prefix of choices,
+    then always picks the first option, recording how many there were. """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.taken = []
+        self.sizes = []
+        self.prob = 1.
+
+    def choose(self, options):
+        """ Options is a list of (value, probability) pairs. """
+        options = [(v, p) for v, p in options if p > 0]
+        i = len(self.taken)
+        if i < len(self.prefix):
+            k = self.prefix[i]
+        else:
+            k = 0
+        self.taken.append(k)
+        self.sizes.append(len(options))
+        v, p = options[k]
+        self.prob *= p
+        return v
+
+
+class _Step(object):
+    """ The sprite bookkeeping within one step. """
+
+    def __init__(self, presences, avatarkeys):
+        self.presences = presences
+        # all avatars that existed during this step, and the same per type
+        self.avatars = []
+        self.avatarGroups = dict((key, []) for key in avatarkeys)
+        self.killed = set()
+        # the sprite lists per group, as cached by the game's event handling
+        self.lists = {}
+
+
+class MDPcompiler(MDPconverter):
+    """ Produces the same MDP as the MDPconverter (with exact probabilities instead of sampled ones),
+    but without running the game dynamics. """
+
+    _avatarclasses = [MovingAvatar, HorizontalAvatar, VerticalAvatar, OrientedAvatar,
+                      RotatingAvatar, RotatingFlippingAvatar, NoisyRotatingFlippingAvatar]
+
+    _effects = [killSprite, stepBack, undoAll, transformTo, teleportToExit, conveySprite,
+                windGust, slipForward, attractGaze, wrapAround]
+
+    _terminations = [SpriteCounter, MultiSpriteCounter, Timeout]
+
+    def __init__(self, game=None, verbose=False, actionset=BASEDIRS, env=None, cache=None, processes=1):
+        MDPconverter.__init__(self, game, verbose=verbose, actionset=actionset, env=env, cache=cache,
+                              processes=processes)
+        self.avgOver = 1
+        self.sas_weights = []
+        self._game = self.env._game
+        self._deadstate = (-1, -1, 'dead')
+        self._compileRules()
+
+    def _samplingSetup(self):
+        return 'compiled'
+
+    def _attr(self, key, name):
+        """ A sprite type's attribute, as it would be on a constructed sprite. """
+        sclass, args, _ = self._game.sprite_constr[key]
+        if name in ['speed', 'cooldown']:
+            return args.get(name) or getattr(sclass, name)
+        return args.get(name, getattr(sclass, name, None))
+
+    def _compileRules(self):
+        g = self._game
+        for t in g.terminations[1:]:
+            assert t.__class__ in self._terminations, 'Not supported: termination %s' % t.__class__.__name__
+        self._rules = []
+        targets = []
+        for g1, g2, effect, kwargs in g.collision_eff:
+            assert effect in self._effects, 'Not supported: effect %s' % effect.__name__
+            kwargs = kwargs.copy()
+            # scores are irrelevant for the MDP
+            kwargs.pop('scoreChange', None)
+            if effect is transformTo:
+                targets.append(kwargs.get('stype', 'wall'))
+            self._rules.append((g1, g2, effect, kwargs))
+
+        self._avatarkeys = [k for k, (sclass, _, _) in g.sprite_constr.items()
+                            if issubclass(sclass, Avatar) and k not in self.env._abs_avatar_types]
+        for key in set(self.env._avatar_types + targets):
+            assert key in self._avatarkeys, 'Not supported: transforming the avatar into %s' % key
+            sclass = g.sprite_constr[key][0]
+            assert sclass in self._avatarclasses, 'Not supported: avatar class %s' % sclass.__name__
+            assert not self._attr(key, 'cooldown'), 'Not supported: avatar with cooldown'
+
+        # all static sprites, with their presence bits
+        bits = {}
+        if self.env.mortalOther:
+            for i, gp in enumerate(self.env._gravepoints):
+                bits[gp] = 1 << i
+        self._statics = []
+        self._staticsByKey = {}
+        for key in self.env._other_types:
+            stypes = g.sprite_constr[key][2]
+            for pos in self.env._obstypes[key]:
+                t = _Token(key, stypes, pos, self._attr(key, 'orientation'), bits.get((key, pos)))
+                self._statics.append(t)
+                self._staticsByKey.setdefault(key, []).append(t)
+        # the groups that have their own (live) sprite list in the game, the others are collected on demand
+        self._concrete = set(k for k in g.sprite_constr if k not in self.env._abs_avatar_types)
+        # the present static sprites of a group, and their index by cell, for a given presences mask
+        self._groupCache = {}
+
+    def _staticGroup(self, g, presences):
+        key = (g, presences)
+        if key not in self._groupCache:
+            if g in self._concrete:
+                cands = self._staticsByKey.get(g, [])
+            else:
+                cands = [t for t in self._statics if g in t.stypes]
+            ts = [t for t in cands if t.bit is None or presences & t.bit]
+            index = {}
+            for t in ts:
+                index.setdefault(t.cell, []).append(t)
+            self._groupCache[key] = (ts, index)
+        return self._groupCache[key]
+
+    def _groupList(self, g, step):
+        """ The sprite list of a group, its length, and a lookup by cell (if it is static). """
+        if g in step.avatarGroups:
+            # live list, it may grow during the event handling
+            ts = step.avatarGroups[g]
+            return ts, len(ts), None
+        ts, index = self._staticGroup(g, step.presences)
+        if g in self._concrete:
+            return ts, len(ts), index
+        avs = [t for t in step.avatars if g in t.stypes]
+        if len(avs) == 0:
+            return ts, len(ts), index
+        ts = ts + avs
+        return ts, len(ts), None
+
+    def _createAvatar(self, step, key, cell, orientation=None):
+        g = self._game
+        stypes = g.sprite_constr[key][2]
+        for pk in stypes[::-1]:
+            if pk in g.singletons and len([t for t in step.avatars
+                                           if pk in t.stypes and t not in step.killed]) > 0:
+                return None
+        if orientation is None:
+            orientation = self._attr(key, 'orientation')
+        t = _Token(key, stypes, cell, orientation, avatar=True)
+        step.avatars.append(t)
+        step.avatarGroups[key].append(t)
+        return t
+
+    @staticmethod
+    def _move(t, direction, speed):
+        if speed != 0 and direction is not None and abs(direction[0]) + abs(direction[1]) > 0:
+            t.cell = (int(t.cell[0] + direction[0] * speed), int(t.cell[1] + direction[1] * speed))
+
+    @staticmethod
+    def _unit(v):
+        """ Direction of a (grid-aligned) vector. """
+        return (cmp(v[0], 0), cmp(v[1], 0))
+
+    def _updateAvatar(self, t, action, branches):
+        sclass = self._game.sprite_constr[t.key][0]
+        t.lastcell = t.cell
+        if issubclass(sclass, RotatingFlippingAvatar):
+            noise = self._attr(t.key, 'noiseLevel')
+            if action is not None and noise > 0:
+                p = min(1., noise * 4)
+                action = branches.choose([(action, 1 - p)] + [(d, p / 4) for d in BASEDIRS])
+        if issubclass(sclass, RotatingAvatar):
+            speed = 0
+            i = BASEDIRS.index(t.orientation)
+            if action == UP:
+                speed = 1
+            elif action == DOWN:
+                if issubclass(sclass, RotatingFlippingAvatar):
+                    t.orientation = BASEDIRS[(i + 2) % len(BASEDIRS)]
+                else:
+                    speed = -1
+            elif action == LEFT:
+                t.orientation = BASEDIRS[(i + 1) % len(BASEDIRS)]
+            elif action == RIGHT:
+                t.orientation = BASEDIRS[(i - 1) % len(BASEDIRS)]
+            self._move(t, t.orientation, speed)
+            return
+        if sclass is HorizontalAvatar and action not in [LEFT, RIGHT]:
+            return
+        if sclass is VerticalAvatar and action not in [UP, DOWN]:
+            return
+        self._move(t, action, self._attr(t.key, 'speed'))
+        if issubclass(sclass, OrientedAvatar) and t.cell != t.lastcell:
+            # only update if the sprite moved
+            t.orientation = self._unit((t.cell[0] - t.lastcell[0], t.cell[1] - t.lastcell[1]))
+
+    def _invalidate(self, step, t):
+        for key in t.stypes:
+            step.lists.pop(key, None)
+
+    def _effect(self, effect, kwargs, s, p, step, branches):
+        if effect is killSprite:
+            step.killed.add(s)
+        elif effect is stepBack:
+            s.cell = s.lastcell
+        elif effect is undoAll:
+            for t in step.avatars:
+                t.cell = t.lastcell
+        elif effect is transformTo:
+            assert s.avatar, 'Not supported: transforming static sprites'
+            new = self._createAvatar(step, kwargs.get('stype', 'wall'), s.cell)
+            if new is not None:
+                if (issubclass(self._game.sprite_constr[s.key][0], OrientedSprite)
+                    and issubclass(self._game.sprite_constr[new.key][0], OrientedSprite)):
+                    new.orientation = s.orientation
+                step.killed.add(s)
+        elif effect is teleportToExit:
+            exits, _ = self._staticGroup(self._attr(p.key, 'stype'), step.presences)
+            e = branches.choose([(e, 1. / len(exits)) for e in exits])
+            s.cell = e.cell
+        elif effect is conveySprite:
+            self._move(s, self._unit(p.orientation), self._attr(p.key, 'strength'))
+            self._invalidate(step, s)
+        elif effect is windGust:
+            strength = self._attr(p.key, 'strength')
+            speed = branches.choose([(strength, 1 / 3.), (strength + 1, 1 / 3.), (strength - 1, 1 / 3.)])
+            if speed != 0:
+                self._move(s, self._unit(p.orientation), speed)
+                self._invalidate(step, s)
+        elif effect is slipForward:
+            prob = kwargs.get('prob', 0.5)
+            if branches.choose([(True, min(1., prob)), (False, 1 - min(1., prob))]):
+                assert s.orientation is not None, 'Not supported: slipping without orientation'
+                self._move(s, self._unit(s.orientation), 1)
+                self._invalidate(step, s)
+        elif effect is attractGaze:
+            prob = kwargs.get('prob', 0.5)
+            if branches.choose([(True, min(1., prob)), (False, 1 - min(1., prob))]):
+                s.orientation = p.orientation
+        elif effect is wrapAround:
+            assert s.orientation is not None, 'Not supported: wrapping without orientation'
+            offset = kwargs.get('offset', 0)
+            x, y = s.cell
+            if s.orientation[0] > 0:
+                x = offset
+            elif s.orientation[0] < 0:
+                x = self._game.width - 1 - offset
+            if s.orientation[1] > 0:
+                y = offset
+            elif s.orientation[1] < 0:
+                y = self._game.height - 1 - offset
+            s.cell = (x, y)
+
+    def _eventHandling(self, step, branches):
+        """ Same logic as BasicGame._eventHandling, on the grid. """
+        ss = step.lists
+        for g1, g2, effect, kwargs in self._rules:
+            for g in [g1, g2]:
+                if g not in ss:
+                    ss[g] = self._groupList(g, step)
+
+            # special case for end-of-screen
+            if g2 == "EOS":
+                for s1 in ss[g1][0]:
+                    x, y = s1.cell
+                    if not (0 <= x < self._game.width and 0 <= y < self._game.height):
+                        self._effect(effect, kwargs, s1, None, step, branches)
+                continue
+
+            # iterate over the shorter one
+            if ss[g1][1] < ss[g2][1]:
+                shortss, (longss, _, index), switch = ss[g1][0], ss[g2], False
+            else:
+                shortss, (longss, _, index), switch = ss[g2][0], ss[g1], True
+            for s1 in shortss:
+                if index is not None:
+                    hits = index.get(s1.cell, [])
+                else:
+                    hits = [s2 for s2 in longss if s2.cell == s1.cell]
+                for s2 in hits:
+                    if s1 is s2:
+                        continue
+                    if switch:
+                        if s2 not in step.killed:
+                            self._effect(effect, kwargs, s2, s1, step, branches)
+                    else:
+                        if s1 not in step.killed:
+                            self._effect(effect, kwargs, s1, s2, step, branches)
+
+    def _count(self, step, stype):
+        res = len([t for t in step.avatars if stype in t.stypes and t not in step.killed])
+        for t in self._staticGroup(stype, step.presences)[0]:
+            if t not in step.killed:
+                res += 1
+        return res
+
+    def _isDone(self, step):
+        for t in self._game.terminations[1:]:
+            if isinstance(t, SpriteCounter):
+                ended = self._count(step, t.stype) <= t.limit
+            elif isinstance(t, MultiSpriteCounter):
+                ended = sum([self._count(step, st) for st in t.stypes]) == t.limit
+            else:
+                ended = self._game.time >= t.limit
+            if ended:
+                return True, t.win
+        return False, False
+
+    def step(self, state, action, branches):
+        """ The outcome (nextstate, ended, win) of taking action (index) in a state,
+        given the random choices. """
+        env = self.env
+        rest = list(state[2:])
+        if env.uniqueAvatar:
+            key = env._avatar_types[0]
+        else:
+            key = rest.pop()
+        presences = 0
+        if env.mortalOther:
+            presences = rest.pop()
+        orientation = None
+        if env.orientedAvatar:
+            orientation = rest.pop()
+
+        step = _Step(presences, self._avatarkeys)
+        avatar = self._createAvatar(step, key, (state[0], state[1]), orientation)
+        self._updateAvatar(avatar, env._actionset[action], branches)
+        self._eventHandling(step, branches)
+
+        for t in step.killed:
+            if t.bit is not None:
+                step.presences &= ~t.bit
+        ended, win = self._isDone(step)
+        alive = [t for t in step.avatars if t not in step.killed]
+        assert len(alive) <= 1, 'Not supported: Only a single avatar can be used'
+        if len(alive) == 0:
+            return self._deadstate, ended, win
+        avatar = alive[0]
+        res = [avatar.cell[0], avatar.cell[1]]
+        if env.orientedAvatar:
+            res.append(avatar.orientation)
+        if env.mortalOther:
+            res.append(step.presences)
+        if not env.uniqueAvatar:
+            res.append(avatar.key)
+        return tuple(res), ended, win
+
+    def outcomes(self, state, action):
+        """ Dictionary of all possible outcomes (nextstate, ended, win) with their probabilities. """
+        res = {}
+        pending = [()]
+        while len(pending) > 0:
+            branches = _Branches(pending.pop())
+            outcome = self.step(state, action, branches)
+            res[outcome] = res.get(outcome, 0) + branches.prob
+            # all alternatives of the choices made after the prefix are still to be explored
+            for i in range(len(branches.prefix), len(branches.taken)):
+                for k in range(1, branches.sizes[i]):
+                    pending.append(tuple(branches.taken[:i]) + (k,))
+        return res
+
+    def _tryAction(self, state, ai, budget=None):
+        if state == self._deadstate:
+            return []
+        a = self.env._actionset[ai]
+        res = []
+        for (dest, ended, win), p in self.outcomes(state, ai).items():
+            if self.verbose:
+                print state, 'do', a, '>', dest, p
+            self.sas_tuples.append((state, a, dest))
+            self.sas_weights.append(p)
+            if ended:
+                if win:
+                    self.rewards[dest] = 1
+                else:
+                    self.rewards[dest] = -1
+            res.append(dest)
+        return res
+
+
+def testAgainstSimulation(avgOver=100):
+    """ Compare the compiled MDPs to the simulated ones, on the maze games: the states and rewards
+    must be the same, and so must the transitions where every action has a single outcome.
+    Otherwise the simulated probabilities (frequencies among avgOver samples) must be within
+    five standard deviations of the compiled ones. """
+    from math import sqrt
+    from time import time
+    from core import VGDLParser
+    from examples.gridphysics.mazes.mazegames import maze_game, polarmaze_game, flippolarmaze_game
+    from examples.gridphysics.mazes.simple import maze_level_1, maze_level_2, maze_level_3, office_layout_2
+    from examples.gridphysics.mazes.fovea import maze_game as fovea_game
+    from examples.gridphysics.mazes.noisyobservations import noisy_maze, maze_89
+    from examples.gridphysics.mazes.rigidzelda import rigidzelda_game, zelda_level
+    from examples.gridphysics.mazes.ringworld import portalmaze_game, portalringworld
+    from examples.gridphysics.mazes.stochastic import stoch_game, stoch_level
+    from examples.gridphysics.mazes.tmaze import polarTmaze_game, Tmaze_game, tmaze
+    from examples.gridphysics.mazes.windy import windy_det_game, windy_stoch_game, windy_level
+    fovea_level = """
+wwwwwwww
+wG. G Gw
+w A .  w
+wG G  .w
+wwwwwwww
+"""
+    games = [('maze', maze_game, maze_level_2), ('polarmaze', polarmaze_game, maze_level_3),
+             ('flippolarmaze', flippolarmaze_game, maze_level_1), ('office', maze_game, office_layout_2),
+             ('fovea', fovea_game, fovea_level), ('noisy', noisy_maze, maze_89),
+             ('rigidzelda', rigidzelda_game, zelda_level), ('portals', portalmaze_game, portalringworld(9)),
+             ('stochastic', stoch_game, stoch_level), ('polartmaze', polarTmaze_game, tmaze(3)),
+             ('tmaze', Tmaze_game, tmaze(4)), ('windy', windy_det_game, windy_level),
+             ('stochwindy', windy_stoch_game, windy_level)]
+    for name, game_str, map_str in games:
+        g = VGDLParser().parseGame(game_str)
+        g.buildLevel(map_str)
+        start = time()
+        C = MDPcompiler(g)
+        Ts, R = C.convert(observations=False)
+        ctime = time() - start
+        start = time()
+        S = MDPconverter(g, avgOver=avgOver)
+        Ts2, R2 = S.convert(observations=False)
+        stime = time() - start
+        assert C.states == S.states, 'Different states for %s' % name
+        assert (R == R2).all(), 'Different rewards for %s' % name
+        err = max([abs(T - T2).max() for T, T2 in zip(Ts, Ts2)])
+        if all((T.data == 1).all() for T in Ts):
+            kind, tolerance = 'deterministic', 0
+            assert all((T != T2).nnz == 0 for T, T2 in zip(Ts, Ts2)), 'Different transitions for %s' % name
+        else:
+            kind, tolerance = 'stochastic', 5 * 0.5 / sqrt(avgOver)
+            assert err <= tolerance, 'Transitions of %s off by %.3f' % (name, err)
+        print '%-14s %5d states, compiled in %.3fs (simulated in %.2fs), %-13s max deviation %.3f (<= %.3f)' \
+              % (name, len(R), ctime, stime, kind, err, tolerance)
+
+
+
+def testParallel(processes=2):
+    """ Compiling with a pool of worker processes must give the same MDP as the serial flood,
+    including the probabilities of the random effects. """
+    from core import VGDLParser
+    from examples.gridphysics.mazes.mazegames import maze_game
+    from examples.gridphysics.mazes.simple import office_layout_2
+    from examples.gridphysics.mazes.stochastic import stoch_game, stoch_level
+    from examples.gridphysics.mazes.windy import windy_stoch_game, windy_level
+    from examples.gridphysics.mazes.ringworld import portalmaze_game, portalringworld
+    games = [('office', maze_game, office_layout_2), ('stochastic', stoch_game, stoch_level),
+             ('stochwindy', windy_stoch_game, windy_level), ('portals', portalmaze_game, portalringworld(9))]
+    for name, game_str, map_str in games:
+        res = []
+        for p in [1, processes]:
+            g = VGDLParser().parseGame(game_str)
+            g.buildLevel(map_str)
+            C = MDPcompiler(g, processes=p)
+            Ts, R = C.convert(observations=False)
+            res.append((C.states, Ts, R))
+        (states, Ts, R), (states2, Ts2, R2) = res
+        assert states == states2, 'Different states for %s' % name
+        assert (R == R2).all(), 'Different rewards for %s' % name
+        err = max([abs(T - T2).max() for T, T2 in zip(Ts, Ts2)])
+        assert err < 1e-9, 'Different transitions for %s' % name
+        print '%-14s %5d states, the same with %d processes' % (name, len(R), processes)
+
+if __name__ == '__main__':
+    testAgainstSimulation()
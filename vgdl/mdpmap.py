@@ -5,8 +5,8 @@ Given a game, we want to produce a list of unique, non-redundant discrete states
 There is a set of permissible discrete actions A.
 Actions and states are identified by their index.
 
-We produce a 3D-array of transition probabilities Ts:
-    Ts[action_id][from_state_id][to_state_id] = Prob(nextstate=to_state | from_state,action)
+We produce a list of (sparse) transition probability matrices Ts:
+    Ts[action_id][from_state_id, to_state_id] = Prob(nextstate=to_state | from_state,action)
 
 We also produce a reward vector for entering each state
 (by default: -1 for losing, +1 for winning, 0 elsewhere)
@@ -18,104 +18,289 @@ Finally, we produce a set of features/observations. Two possibilities:
 
 """
 
-from scipy import zeros
+from math import ceil, log
+from scipy import zeros, ones, array, bincount, concatenate, flatnonzero, diff
+from scipy.sparse import csr_matrix
 from pybrain.utilities import flood
 from ontology import BASEDIRS
 from interfaces import GameEnvironment
 
 
+# the converter used by the pool workers: set before forking, so every
+# worker process expands states on its own copy of the game environment
+_worker_converter = None
+
+
+def _initWorker():
+    # forked workers would otherwise all draw the same random numbers
+    from random import seed
+    seed()
+
+
+def _expandStates(states):
+    C = _worker_converter
+    C.sas_tuples = []
+    if C.sas_weights is not None:
+        C.sas_weights = []
+    C.rewards = {}
+    for state in states:
+        C.tryMoves(state)
+    return C.sas_tuples, C.sas_weights, C.rewards
+
+
 class MDPconverter(object):
     """ Simple case: Assume the game has a single avatar,
         physics are grid-based, and all other sprites are Immovables.
     """
 
-    def __init__(self, game=None, verbose=False, actionset=BASEDIRS, env=None, avgOver=10):
+    def __init__(self, game=None, verbose=False, actionset=BASEDIRS, env=None, avgOver=10, processes=1,
+                 cache=None, adaptive=False, tolerance=0.1, confidence=0.9):
         if env is None:
             env = GameEnvironment(game, actionset=actionset)
         self.env = env
         self.verbose = verbose
+        # with more than one process, the state space is flooded layer by layer in parallel
+        self.processes = processes
+        # optionally, an MDPcache that stores the conversion results on disk
+        self.cache = cache
         self.sas_tuples = []
+        # optionally, the probability of each of these transitions (otherwise they are equally likely samples)
+        self.sas_weights = None
         self.rewards = {}
         if env._game.is_stochastic:
             # in the stochastic case, how often is every state-action pair tried?
             self.avgOver = avgOver
         else:
             self.avgOver = 1
+        # optionally, stop sampling a state-action pair earlier once its outcomes are stable,
+        # in which case avgOver is the maximal budget
+        self.adaptive = adaptive
+        self.tolerance = tolerance
+        self.confidence = confidence
 
-    def convert(self, observations=True):
+    def convert(self, observations=True, dense=False):
+        """ Returns the transition matrices (one per action) and the reward vector,
+        and optionally the feature map. The transition matrices are in sparse
+        CSR format, unless dense ones are asked for. """
+        key = None
+        cached = None
+        if self.cache is not None:
+            g = self.env._game
+            key = self.cache.key(g.game_str, g.level_str, self.env._actionset, self._samplingSetup(),
+                                 (observations, self.env.__class__.__name__))
+            if key is not None:
+                cached = self.cache.load(key)
+        if cached is not None:
+            states, Ts, R, fMap = cached
+            self._setStates(states)
+            if self.verbose:
+                print 'Loaded from cache:', key
+        else:
+            Ts, R, fMap = self._convert(observations)
+            if key is not None:
+                self.cache.store(key, self.states, Ts, R, fMap)
+        if dense:
+            Ts = [T.toarray() for T in Ts]
+        if observations:
+            return Ts, R, fMap
+        else:
+            return Ts, R
+
+    def _samplingSetup(self):
+        """ How the transition probabilities are estimated (part of the cache key). """
+        if self.adaptive:
+            return (self.avgOver, self.tolerance, self.confidence)
+        return self.avgOver
+
+    def _setStates(self, states):
+        self.states = states
+        # interning table: the states list maps indices to states, and this dict the reverse
+        self.stateIndex = {}
+        for si, s in enumerate(states):
+            self.stateIndex[s] = si
+
+    def _convert(self, observations):
         if self.verbose:
             if observations:
                 print 'Number of features:', 5 * len(self.env._obstypes)
         initSet = [self.env._initstate]
-        self.states = sorted(flood(self.tryMoves, None, initSet))
+        if self.processes > 1:
+            self._setStates(sorted(self._parallelFlood(initSet)))
+        else:
+            self._setStates(sorted(flood(self.tryMoves, None, initSet)))
         dim = len(self.states)
         if self.verbose:
             print 'Actual states:', dim
             print 'Non-zero rewards:', self.rewards
             print 'Initial state', initSet[0]
-        Ts = [zeros((dim, dim)) for _ in self.env._actionset]
         R = zeros(dim)
-        statedic = {}
+        statedic = self.stateIndex
         actiondic = {}
-        for si, pos in enumerate(self.states):
-            statedic[pos] = si
         for ai, a in enumerate(self.env._actionset):
             actiondic[a] = ai
         for pos, val in self.rewards.items():
             R[statedic[pos]] += val
-        for pos, a, dest in self.sas_tuples:
-            ai = actiondic[a]
-            si = statedic[pos]
-            di = statedic[dest]
-            Ts[ai][si, di] += 1. / self.avgOver
+        ais = array([actiondic[a] for _, a, _ in self.sas_tuples], dtype=int)
+        sis = array([statedic[pos] for pos, _, _ in self.sas_tuples], dtype=int)
+        dis = array([statedic[dest] for _, _, dest in self.sas_tuples], dtype=int)
+        if self.sas_weights is None:
+            ws = ones(len(self.sas_tuples))
+        else:
+            ws = array(self.sas_weights, dtype=float)
+        Ts = [self._transitionMatrix(sis[ais == ai], dis[ais == ai], dim, ws[ais == ai])
+              for ai in range(len(self.env._actionset))]
         if self.verbose:
             print 'Built Ts.'
-        for T in Ts:
-            for ti, row in enumerate(T):
-                if sum(row) > 0:
-                    row /= sum(row)
-                else:
-                    row[ti] = 1
-        if self.verbose:
-            print 'Normalized Ts.'
+        fMap = None
         if observations:
             # one observation for current position and each of the 4 neighbors.
-            fMap = zeros((len(self.env._obstypes) * 5, dim))
-            for si, state in enumerate(self.states):
-                fMap[:, si] = self.env.getSensors(state)
+            fMap = self.env.getSensorsBatch(self._stateArray())
             if self.verbose:
                 print 'Built features.'
-            return Ts, R, fMap
-        else:
-            return Ts, R
+        return Ts, R, fMap
+
+    def _stateArray(self):
+        """ The avatar positions (and orientation indices) of all states, as an array. """
+        res = zeros((len(self.states), 3), dtype=int)
+        for si, s in enumerate(self.states):
+            res[si, :2] = s[:2]
+            if self.env.orientedAvatar and s[2] in BASEDIRS:
+                res[si, 2] = BASEDIRS.index(s[2])
+        return res
+
+    @staticmethod
+    def _transitionMatrix(sis, dis, dim, weights=None):
+        """ Normalized transition matrix from the observed (origin, destination) index pairs,
+        optionally weighted. States that were never left (e.g. terminal ones) get a self-loop. """
+        if weights is None:
+            weights = ones(len(sis))
+        counts = bincount(sis, weights, minlength=dim)
+        loops = flatnonzero(counts == 0)
+        rows = concatenate([sis, loops])
+        cols = concatenate([dis, loops])
+        vals = concatenate([weights, ones(len(loops))])
+        # duplicate entries are summed up, before normalizing (so a single outcome gets exactly 1)
+        T = csr_matrix((vals, (rows, cols)), shape=(dim, dim))
+        counts[loops] = 1
+        T.data /= counts.repeat(diff(T.indptr))
+        return T
 
     def initIndex(self):
-        return self.states.index(self.env._initstate)
+        return self.stateIndex[self.env._initstate]
+
+    def _parallelFlood(self, initSet, chunksPerProcess=4):
+        """ Breadth-first expansion where each layer of new states is split
+        among a pool of (forked) worker processes. The transitions (with their weights, if any)
+        and rewards are merged here, so the result is the same as with the serial flood. """
+        from multiprocessing import Pool
+        global _worker_converter
+        _worker_converter = self
+        pool = Pool(self.processes, _initWorker)
+        try:
+            known = set(initSet)
+            frontier = sorted(known)
+            while len(frontier) > 0:
+                # states that end the game are not expanded further
+                frontier = [s for s in frontier if s not in self.rewards]
+                size = max(1, -(-len(frontier) // (self.processes * chunksPerProcess)))
+                chunks = [frontier[i:i + size] for i in range(0, len(frontier), size)]
+                new = set()
+                for sas_tuples, sas_weights, rewards in pool.map(_expandStates, chunks):
+                    self.sas_tuples.extend(sas_tuples)
+                    if sas_weights is not None:
+                        self.sas_weights.extend(sas_weights)
+                    self.rewards.update(rewards)
+                    new.update(dest for _, _, dest in sas_tuples)
+                frontier = sorted(new.difference(known))
+                known.update(frontier)
+                if self.verbose:
+                    print 'Flooded', len(known), 'states,', len(frontier), 'new.'
+        finally:
+            pool.close()
+            pool.join()
+            _worker_converter = None
+        return known
 
     def tryMoves(self, state):
         res = []
         if state in self.rewards:
             return res
-        for ai, a in self.avgOver * list(enumerate(self.env._actionset)):
-            # reset game to starting state
-            self.env.setState(state)
+        if self.adaptive:
+            for ai in range(len(self.env._actionset)):
+                res.extend(self._tryAction(state, ai))
+        else:
+            # one sample of every action in turn, avgOver times (the order of the random draws)
+            for _ in range(self.avgOver):
+                for ai in range(len(self.env._actionset)):
+                    res.extend(self._tryAction(state, ai, 1))
+        # pass on the list of neighboring states
+        return res
+
+    def _tryAction(self, state, ai, budget=None):
+        """ Sample the outcomes of one state-action pair, and return the distinct next states.
+
+        By default that is done budget (or avgOver) times. In adaptive mode, the first round of samples
+        is just large enough that, if they all agree, any other outcome is less likely
+        than the tolerance (with the given confidence). Otherwise further rounds of doubling
+        size are drawn, until the empirical distribution of next states changes less
+        than the tolerance (in total variation) over a round, or the budget of avgOver
+        samples is used up. """
+        a = self.env._actionset[ai]
+        if budget is None:
+            budget = self.avgOver
+        counts = {}
+        n = 0
+        if self.adaptive:
+            batch = int(ceil(log(1 - self.confidence) / log(1 - self.tolerance)))
+        else:
+            batch = self.avgOver
+        while n < budget:
+            before, nbefore = dict(counts), n
+            for dest, ended, win in self.sampleOutcomes(state, ai, min(batch, budget - n)):
+                if self.verbose:
+                    print state, 'do', a, '>', dest
+                self.sas_tuples.append((state, a, dest))
+                # remember reward if the final state ends the game
+                if ended:
+                    if win:
+                        self.rewards[dest] = 1
+                    else:
+                        self.rewards[dest] = -1
+                    if self.verbose:
+                        print 'Ends with', win
+                counts[dest] = counts.get(dest, 0) + 1
+                n += 1
+            if self.adaptive and len(counts) == 1:
+                # deterministic (with high confidence)
+                break
+            if nbefore > 0:
+                change = sum(abs(counts[d] / float(n) - before.get(d, 0) / float(nbefore))
+                             for d in counts) / 2.
+                if change < self.tolerance:
+                    break
+            batch = n
+        return counts.keys()
+
+    def sampleOutcomes(self, state, ai, num):
+        """ Returns a list of num sampled (nextstate, ended, win) tuples, for taking action ai in state.
+        In adaptive mode, the game is only restored to the state when the previous sample left it:
+        the state is then assumed to capture everything that matters, so a self-transition
+        changes nothing. Otherwise every sample starts from setState, as it always did
+        (which also resets the avatar's lastrect and lastmove). """
+        res = []
+        current = None
+        for _ in range(num):
+            if current != state or not self.adaptive:
+                # reset game to starting state
+                self.env.setState(state)
             self.env.performAction(ai)
-            # remember the outcome of the action
             dest = self.env.getState()
-            res.append(dest)
-            if self.verbose:
-                print state, 'do', a, '>', dest
-            self.sas_tuples.append((state, a, dest))
-            # remember reward if the final state ends the game
             ended, win = self.env._isDone()
+            res.append((dest, ended, win))
             if ended:
-                if win:
-                    self.rewards[dest] = 1
-                else:
-                    self.rewards[dest] = -1
-                if self.verbose:
-                    print 'Ends with', win
-        # pass on the list of neighboring states
+                current = None
+            else:
+                current = dest
         return res
 
 
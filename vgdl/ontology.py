@@ -208,12 +208,19 @@ class OrientedSprite(VGDLSprite):
     draw_arrow = False
     orientation = RIGHT
 
-    def _draw(self, game):
+    def _drawShape(self, game, screen, rect):
         """ With a triangle that shows the orientation. """
-        VGDLSprite._draw(self, game)
+        r = VGDLSprite._drawShape(self, game, screen, rect)
         if self.draw_arrow:
             col = (self.color[0], 255 - self.color[1], self.color[2])
-            pygame.draw.polygon(game.screen, col, triPoints(self.rect, unitVector(self.orientation)))
+            pygame.draw.polygon(screen, col, triPoints(rect, unitVector(self.orientation)))
+        return r
+
+    def _drawKey(self, game):
+        res = VGDLSprite._drawKey(self, game)
+        if self.draw_arrow:
+            res += (tuple(self.orientation),)
+        return res
 
 
 class Conveyor(OrientedSprite):
@@ -778,7 +785,7 @@ class MultiSpriteCounter(Termination):
 # ---------------------------------------------------------------------
 def killSprite(sprite, partner, game):
     """ Kill command """
-    game.kill_list.append(sprite)
+    game._killSprite(sprite)
 
 
 def cloneSprite(sprite, partner, game):
@@ -0,0 +1,286 @@
+'''
+Recording videos of games, by streaming the raw frames into an ffmpeg process,
+or as animated GIFs.
+
+The frames are captured in the game loop (as RGB bytes, from the screen, or rendered offscreen
+if there is none), and a background thread feeds them to the encoder through a bounded queue,
+so the game loop does not wait for the encoding. If the encoder falls behind that far,
+the game loop waits after all (or, optionally, frames are dropped, with a warning).
+
+Start one with BasicGame.startRecording(), or by playing a game with persist_movie=True.
+
+GIFs are written while the game is played (no image files per frame), with only the rectangle
+of every frame that changed since the previous one, so the memory use does not depend on the length.
+'''
+
+import os
+import pygame
+import subprocess
+import warnings
+from threading import Thread
+from Queue import Queue, Full
+from numpy import frombuffer, uint8
+from pybrain.utilities import setAllArgs
+
+
+def _frameBytes(game, size):
+    """ The current frame of the game, as RGB bytes (row by row). """
+    screen = getattr(game, 'screen', None)
+    if screen is not None and screen.get_size() == size and screen.get_bitsize() >= 24:
+        return pygame.image.tostring(screen, 'RGB')
+    else:
+        # headless: the screen is not drawn on (or, on the 8-bit dummy display, without colors)
+        return game.render_array().tostring()
+
+
+def _makeDirs(filename):
+    outdir = os.path.dirname(filename)
+    if outdir and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+
+class MovieRecorder(object):
+    """ Encodes the frames of a game (of a fixed size) into a video file. """
+
+    ffmpeg = 'ffmpeg'
+    codec = 'libx264'
+    # the pixel format of the video (the one most players support)
+    pixelFormat = 'yuv420p'
+    # pad odd frame sizes by a black row or column (yuv420p needs even ones)
+    padEven = True
+    bitrate = None
+    frameRate = 30
+    # the number of captured frames that may wait for the encoder
+    queueSize = 100
+    # wait for the encoder if the queue is full, instead of dropping the frame
+    blocking = True
+
+    def __init__(self, filename, size, **kwargs):
+        setAllArgs(self, kwargs)
+        self.filename = filename
+        self.size = tuple(size)
+        self.frames = 0
+        self.dropped = 0
+        self._error = None
+        _makeDirs(filename)
+        cmd = [self.ffmpeg, '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '%dx%d' % self.size, '-r', str(self.frameRate),
+               '-i', '-', '-an', '-vcodec', self.codec, '-pix_fmt', self.pixelFormat]
+        if self.padEven and (self.size[0] % 2 or self.size[1] % 2):
+            cmd += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2']
+        if self.bitrate is not None:
+            cmd += ['-b:v', str(self.bitrate)]
+        self._process = subprocess.Popen(cmd + [filename], stdin=subprocess.PIPE)
+        self._queue = Queue(self.queueSize)
+        self._writer = Thread(target=self._write)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _write(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if self._error is not None:
+                # keep emptying the queue
+                continue
+            try:
+                self._process.stdin.write(data)
+            except IOError, e:
+                self._error = e
+
+    def addFrame(self, game):
+        """ Capture the game's current frame. """
+        data = _frameBytes(game, self.size)
+        try:
+            self._queue.put(data, self.blocking)
+            self.frames += 1
+        except Full:
+            self.dropped += 1
+            if self.dropped == 1:
+                warnings.warn('Recording %s: the encoder is too slow, frames are dropped' % self.filename)
+
+    def close(self):
+        """ Wait for the encoding to finish, returns the file name. """
+        self._queue.put(None)
+        self._writer.join()
+        self._process.stdin.close()
+        code = self._process.wait()
+        if self._error is not None or code != 0:
+            raise IOError('Encoding %s failed (%s)' % (self.filename, self._error or 'exit code %d' % code))
+        if self.dropped > 0:
+            print 'Recording %s: %d frames dropped, the encoder was too slow.' % (self.filename, self.dropped)
+        return self.filename
+
+
+class GifRecorder(object):
+    """ Writes the frames of a game (of a fixed size) into an animated GIF, as they come. """
+
+    # seconds per frame
+    duration = 0.1
+    # only write the area of a frame that changed since the previous one
+    subRectangles = True
+    # one palette for all frames: by default, the colors as they occur (the first 256 of them),
+    # or an array of RGB colors (see images2gif.GifStreamWriter)
+    palette = None
+
+    def __init__(self, filename, size, **kwargs):
+        from external_libs.images2gif import GifStreamWriter
+        setAllArgs(self, kwargs)
+        self.filename = filename
+        self.size = tuple(size)
+        _makeDirs(filename)
+        self._writer = GifStreamWriter(filename, self.duration, subRectangles=self.subRectangles,
+                                       palette=self.palette)
+
+    def addFrame(self, game):
+        """ Capture the game's current frame. """
+        w, h = self.size
+        self._writer.addFrame(frombuffer(_frameBytes(game, self.size), uint8).reshape(h, w, 3))
+
+    def close(self):
+        """ Finish the GIF file, returns its name. """
+        self._writer.close()
+        return self.filename
+
+
+def testGifRecorder(steps=100):
+    """ Record random play of a few games as GIFs (also with makeGifVideo), and check that every
+    decoded frame is exactly the played one, as drawn sprite by sprite (static ones included).
+    Then the same with changes of one pixel column or row. """
+    import shutil
+    import tempfile
+    from random import choice
+    from numpy import random
+    from core import VGDLParser, _referenceFrame
+    from interfaces import GameEnvironment
+    from tools import makeGifVideo
+    from external_libs.images2gif import GifStreamWriter, readGif
+    from examples.gridphysics.mazes import polarmaze_game, maze_level_2
+    from examples.gridphysics.frogs import frog_game, frog_level
+    from examples.gridphysics.zelda import zelda_game, zelda_level
+
+    def check(name, filename, frames):
+        decoded = readGif(filename)
+        assert len(decoded) == len(frames), 'Wrong number of frames in %s' % name
+        for i, (d, f) in enumerate(zip(decoded, frames)):
+            assert (d[:, :, :3] == f).all(), 'Frame %d of %s differs' % (i, name)
+        print '%-10s %4d frames decoded exactly' % (name, len(frames))
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name, game_str, map_str in [('polarmaze', polarmaze_game, maze_level_2),
+                                        ('frogs', frog_game, frog_level),
+                                        ('zelda', zelda_game, zelda_level)]:
+            g = VGDLParser().parseGame(game_str)
+            g.buildLevel(map_str)
+            g._initScreen(g.screensize, headless=True)
+            actions = [None] + sorted(g.getPossibleActions().values())
+            recorder = GifRecorder(os.path.join(tmpdir, name + '.gif'), g.screensize)
+            frames = []
+            for _ in range(steps):
+                g.tick(choice(actions), headless=True)
+                recorder.addFrame(g)
+                frames.append(_referenceFrame(g))
+                if g.ended:
+                    break
+            # with static sprites (pre-rendered by the game) that show
+            statics = [sp for key in g._static_keys for sp in g.sprite_groups.get(key, [])
+                       if tuple(sp.color) != g._background_color]
+            assert len(statics) > 0, 'No visible static sprites in %s' % name
+            check(name, recorder.close(), frames)
+
+        # with a (dummy) display, as makeGifVideo uses
+        g = VGDLParser().parseGame(polarmaze_game)
+        g.buildLevel(maze_level_2)
+        env = GameEnvironment(g)
+        actions = [choice(range(4)) for _ in range(steps)]
+        filename = makeGifVideo(env, actions, outdir=tmpdir + '/')
+        frames = []
+        env.reset()
+        env.rollOut(actions, callback=lambda *_: frames.append(_referenceFrame(g)))
+        check('video', filename, frames)
+
+        colors = random.randint(0, 256, (6, 3)).astype(uint8)
+        frame = colors[random.randint(0, 6, (40, 50))]
+        frames = [frame]
+        for i in range(steps):
+            frame = frame.copy()
+            x, y, c = random.randint(50), random.randint(40), colors[random.randint(6)]
+            if i % 2:
+                frame[y:y + 5, x] = c
+            else:
+                frame[y, x:x + 5] = c
+            frames.append(frame)
+        filename = os.path.join(tmpdir, 'thin.gif')
+        writer = GifStreamWriter(filename)
+        for frame in frames:
+            writer.addFrame(frame)
+        writer.close()
+        check('thin', filename, frames)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _decodeVideo(filename, size, ffmpeg='ffmpeg'):
+    """ All frames of a video file, decoded by ffmpeg, as a (frames, height, width, 3) uint8 array
+    (the given size is the encoded one, padded or not). """
+    w, h = size
+    p = subprocess.Popen([ffmpeg, '-loglevel', 'error', '-i', filename,
+                          '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'], stdout=subprocess.PIPE)
+    data = p.communicate()[0]
+    assert p.returncode == 0, 'Decoding %s failed' % filename
+    return frombuffer(data, uint8).reshape(-1, h, w, 3)
+
+
+def testMovieRecorder(steps=100):
+    """ Record random play of a few games (headless) into videos, and decode them with ffmpeg:
+    losslessly encoded, every frame is exactly the played one, as drawn sprite by sprite;
+    with the default (lossy) settings, no frame is missing and all are close. """
+    import shutil
+    import tempfile
+    from random import choice
+    from core import VGDLParser, _referenceFrame
+    from examples.gridphysics.mazes import polarmaze_game, maze_level_2
+    from examples.gridphysics.aliens import aliens_game, aliens_level
+    from examples.gridphysics.zelda import zelda_game, zelda_level
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name, game_str, map_str in [('polarmaze', polarmaze_game, maze_level_2),
+                                        ('aliens', aliens_game, aliens_level),
+                                        ('zelda', zelda_game, zelda_level)]:
+            g = VGDLParser().parseGame(game_str)
+            g.buildLevel(map_str)
+            g._initScreen(g.screensize, headless=True)
+            actions = [None] + sorted(g.getPossibleActions().values())
+            lossless = MovieRecorder(os.path.join(tmpdir, name + '.mkv'), g.screensize,
+                                     codec='ffv1', pixelFormat='bgr0', padEven=False)
+            lossy = MovieRecorder(os.path.join(tmpdir, name + '.mp4'), g.screensize)
+            frames = []
+            for _ in range(steps):
+                g.tick(choice(actions), headless=True)
+                lossless.addFrame(g)
+                lossy.addFrame(g)
+                frames.append(_referenceFrame(g))
+                if g.ended:
+                    break
+            assert lossless.dropped == lossy.dropped == 0
+
+            decoded = _decodeVideo(lossless.close(), g.screensize, lossless.ffmpeg)
+            assert len(decoded) == len(frames), 'Wrong number of frames in %s' % name
+            for i, (d, f) in enumerate(zip(decoded, frames)):
+                assert (d == f).all(), 'Frame %d of %s differs' % (i, name)
+            w, h = g.screensize
+            decoded = _decodeVideo(lossy.close(), (w + w % 2, h + h % 2), lossy.ffmpeg)
+            assert len(decoded) == len(frames), 'Wrong number of frames in %s' % name
+            error = max(abs(d[:h, :w].astype(int) - f).mean() for d, f in zip(decoded, frames))
+            assert error < 2, 'Frames of %s too far off (mean error %.1f)' % (name, error)
+            print '%-10s %4d frames decoded exactly (lossy: mean error up to %.2f)' % (name, len(frames), error)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    testGifRecorder()
+    testMovieRecorder()
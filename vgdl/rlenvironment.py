@@ -174,6 +174,17 @@ class RLEnvironment(StateObsHandler):
         if action is None:
             return
 
+        if self._useTransitionCache(onlyavatar):
+            self._performCachedAction(action)
+        else:
+            self._simulateAction(action, onlyavatar)
+
+        if self.recordingEnabled:
+            self._previous_state = self._last_state
+            self._last_state = self.getState()
+            self._allEvents.append((self._previous_state, action, self._last_state))
+
+    def _simulateAction(self, action, onlyavatar=False):
         # take action and compute consequences
         # replace the method that reads multiple action keys with a fn that just
         # returns the currently desired action
@@ -200,11 +211,6 @@ class RLEnvironment(StateObsHandler):
             VGDLSprite.dirtyrects = []
             pygame.time.wait(self.actionDelay)
 
-        if self.recordingEnabled:
-            self._previous_state = self._last_state
-            self._last_state = self.getState()
-            self._allEvents.append((self._previous_state, action, self._last_state))
-
     def step(self, action):
         if action != None:
             self._performAction(action)
@@ -0,0 +1,255 @@
+'''
+Evaluating many action sequences (or random playouts) from the same game state,
+e.g. for tree search or rolling-horizon planning.
+
+The sequences are arranged in a prefix tree, so every shared prefix is simulated only once:
+the game is snapshotted at the nodes where the tree branches, and restored before
+every branch but the first one.
+
+This works on any game that can be played with BasicGame.tick (the actions are keys),
+not only the static-world ones of the StateObsHandler.
+'''
+
+from random import choice
+from pybrain.utilities import setAllArgs
+
+# the engine used by the pool workers: set before forking, so every
+# worker process plays on its own copy of the game
+_worker_engine = None
+
+
+def _initWorker():
+    # forked workers would otherwise all draw the same random numbers
+    from random import seed
+    seed()
+
+
+def _evaluateChunk(args):
+    sequences, playoutDepth = args
+    return _worker_engine._evaluate(sequences, playoutDepth)
+
+
+def _copySprite(s):
+    """ A copy of a sprite that shares nothing mutable with it. """
+    c = object.__new__(s.__class__)
+    c.__dict__ = s.__dict__.copy()
+    c.rect = s.rect.copy()
+    if s.lastrect is s.rect:
+        c.lastrect = c.rect
+    else:
+        c.lastrect = s.lastrect.copy()
+    c.resources = s.resources.copy()
+    return c
+
+
+def snapshot(game):
+    """ Everything in the game that changes while it is played.
+    Unlike getFullState, this preserves the sprite order and all sprite attributes,
+    so a restored game continues exactly like the original would. """
+    copies = {}
+    groups = {}
+    for key, ss in game.sprite_groups.iteritems():
+        groups[key] = []
+        for s in ss:
+            c = _copySprite(s)
+            copies[id(s)] = c
+            groups[key].append(c)
+    return (groups, [copies[id(s)] for s in game._avatars], [copies[id(s)] for s in game.kill_list],
+            game.score, game.time, game.ended, game.num_sprites)
+
+
+def restore(game, snap):
+    """ Set the game to a snapshot (which can be restored again later). """
+    groups, avatars, kill_list, game.score, game.time, game.ended, game.num_sprites = snap
+    copies = {}
+    game.sprite_groups.clear()
+    for key, ss in groups.iteritems():
+        game.sprite_groups[key] = []
+        for s in ss:
+            c = _copySprite(s)
+            copies[id(s)] = c
+            game.sprite_groups[key].append(c)
+    game._avatars = [copies[id(s)] for s in avatars]
+    game.kill_list = [copies[id(s)] for s in kill_list]
+    game._sprite_generation += 1
+    # static sprites may have been killed or created since
+    game._staticsChanged()
+
+
+class _Node(object):
+    """ A node of the prefix tree: the sequences ending here, and the children per action. """
+
+    def __init__(self):
+        self.ends = []
+        self.children = {}
+
+
+class RolloutEngine(object):
+    """ Plays action sequences from a root state of a game.
+
+    The actions are given as indices into the list of keys (by default, the avatar's possible actions),
+    which may include None for doing nothing. The return of a sequence is the discounted sum
+    of score changes, plus optional rewards for winning or losing.
+    """
+
+    discountFactor = 1.
+    winReward = 0.
+    loseReward = 0.
+
+    # with more than one process, the sequences are divided among a pool of forked workers
+    processes = 1
+
+    def __init__(self, game, actions=None, policy=None, **kwargs):
+        setAllArgs(self, kwargs)
+        self.game = game
+        if actions is None:
+            actions = sorted(game.getPossibleActions().values())
+        self.actions = actions
+        # the action (index) choice during playouts, a function of the game (uniformly random by default)
+        if policy is None:
+            policy = lambda _: choice(range(len(self.actions)))
+        self.policy = policy
+        if not hasattr(game, 'screen'):
+            game._initScreen(game.screensize, headless=True)
+        self.setRoot()
+
+    def setRoot(self):
+        """ The current state of the game becomes the one all sequences start from. """
+        self.game._clearAll(False)
+        self.root = snapshot(self.game)
+
+    def reset(self):
+        """ Set the game back to the root state. """
+        restore(self.game, self.root)
+
+    def evaluate(self, sequences, playoutDepth=0):
+        """ Returns, for each action sequence, the return, the number of steps taken,
+        and the terminal flag: None if the game is not over, otherwise whether it was won.
+        Optionally, each sequence is continued by a playout of up to playoutDepth actions.
+        The game is left in the root state. """
+        if self.processes > 1 and len(sequences) > 1:
+            res = self._parallelEvaluate(sequences, playoutDepth)
+        else:
+            res = self._evaluate(sequences, playoutDepth)
+        self.reset()
+        returns, lengths, terminals = zip(*res) if len(res) > 0 else ([], [], [])
+        return list(returns), list(lengths), list(terminals)
+
+    def playouts(self, num, depth):
+        """ Returns, lengths and terminal flags of a number of playouts from the root. """
+        return self.evaluate([[]] * num, playoutDepth=depth)
+
+    def _evaluate(self, sequences, playoutDepth):
+        root = _Node()
+        for i, seq in enumerate(sequences):
+            node = root
+            for a in seq:
+                if a not in node.children:
+                    node.children[a] = _Node()
+                node = node.children[a]
+            node.ends.append(i)
+        res = [None] * len(sequences)
+        self.reset()
+        self._expand(root, 0., 0, 1., None, playoutDepth, res)
+        return res
+
+    def step(self, action):
+        """ Take one action (index), return the reward and the terminal flag. """
+        g = self.game
+        score = g.score
+        g.tick(self.actions[action])
+        g._clearAll(False)
+        reward = g.score - score
+        for t in g.terminations[1:]:
+            ended, win = t.isDone(g)
+            if ended:
+                g.ended = True
+                if win:
+                    return reward + self.winReward, win
+                else:
+                    return reward + self.loseReward, win
+        return reward, None
+
+    def _expand(self, node, ret, steps, discount, terminal, playoutDepth, res):
+        if terminal is not None:
+            # the game is over, nothing more to simulate in this subtree
+            stack = [node]
+            while len(stack) > 0:
+                n = stack.pop()
+                for i in n.ends:
+                    res[i] = (ret, steps, terminal)
+                stack.extend(n.children.values())
+            return
+
+        branches = [(None, i) for i in node.ends if playoutDepth > 0]
+        for i in node.ends:
+            if playoutDepth == 0:
+                res[i] = (ret, steps, None)
+        branches += sorted(node.children.items())
+        snap = None
+        if len(branches) > 1:
+            snap = snapshot(self.game)
+        for bi, (a, child) in enumerate(branches):
+            if bi > 0:
+                restore(self.game, snap)
+            if a is None:
+                res[child] = self.playout(playoutDepth, ret, steps, discount)
+            else:
+                r, t = self.step(a)
+                self._expand(child, ret + discount * r, steps + 1, discount * self.discountFactor,
+                             t, playoutDepth, res)
+
+    def playout(self, depth, ret=0., steps=0, discount=1.):
+        """ Continue the game with up to depth actions chosen by the policy,
+        returns the same as for a single sequence. """
+        for _ in range(depth):
+            r, t = self.step(self.policy(self.game))
+            ret += discount * r
+            steps += 1
+            discount *= self.discountFactor
+            if t is not None:
+                return ret, steps, t
+        return ret, steps, None
+
+    def _parallelEvaluate(self, sequences, playoutDepth, chunksPerProcess=4):
+        """ The sequences are sorted, so that the ones sharing prefixes mostly end up in the same chunk. """
+        from multiprocessing import Pool
+        global _worker_engine
+        order = sorted(range(len(sequences)), key=lambda i: list(sequences[i]))
+        size = max(1, -(-len(order) // (self.processes * chunksPerProcess)))
+        chunks = [order[i:i + size] for i in range(0, len(order), size)]
+        _worker_engine = self
+        pool = Pool(self.processes, _initWorker)
+        try:
+            results = pool.map(_evaluateChunk, [([sequences[i] for i in c], playoutDepth) for c in chunks])
+        finally:
+            pool.close()
+            pool.join()
+            _worker_engine = None
+        res = [None] * len(sequences)
+        for c, cres in zip(chunks, results):
+            for i, r in zip(c, cres):
+                res[i] = r
+        return res
+
+
+def testRollouts():
+    from time import time
+    from core import VGDLParser
+    from examples.gridphysics.aliens import aliens_game, aliens_level
+    g = VGDLParser().parseGame(aliens_game)
+    g.buildLevel(aliens_level)
+    E = RolloutEngine(g, discountFactor=0.95, winReward=10, loseReward=-10)
+    # all sequences of length 3, extended by random playouts
+    seqs = [[a, b, c] for a in range(len(E.actions)) for b in range(len(E.actions)) for c in range(len(E.actions))]
+    start = time()
+    returns, lengths, terminals = E.evaluate(seqs, playoutDepth=20)
+    print len(seqs), 'sequences in %.2fs' % (time() - start)
+    print zip(returns, lengths, terminals)[:5]
+    start = time()
+    returns, lengths, terminals = E.playouts(50, 100)
+    print '50 playouts in %.2fs' % (time() - start), max(returns), max(lengths)
+
+
+if __name__ == '__main__':
+    testRollouts()
@@ -0,0 +1,178 @@
+'''
+Solvers for the (explicit) MDPs produced by the MDPconverter.
+
+The transition matrices can be sparse or dense, one per action, and the rewards are
+obtained when entering a state (the same conventions as the PyBrain model-based learners):
+
+    V(s) = max_a sum_s' T_a[s, s'] * (R[s'] + discountFactor * V(s'))
+
+All solvers return the value vector, a deterministic policy as a (states x actions)
+matrix of probabilities (so it can be used directly by a PolicyDrivenAgent),
+and a dictionary of statistics (iterations, backups, residual, wall time).
+'''
+
+from time import time
+from heapq import heappush, heappop
+from numpy import zeros, array, abs
+from scipy.sparse import csr_matrix, vstack as spvstack
+
+
+def _stackedTransitions(Ts):
+    """ All transition matrices in one sparse matrix, with the rows of action a
+    at the positions a*dim .. (a+1)*dim-1 """
+    return csr_matrix(spvstack([csr_matrix(T) for T in Ts]))
+
+
+def _qValues(TT, numactions, R, V, discountFactor):
+    """ Array (actions x states) of action values. """
+    return TT.dot(R + discountFactor * V).reshape(numactions, len(R))
+
+
+def _onehot(actions, numactions):
+    policy = zeros((len(actions), numactions))
+    policy[range(len(actions)), actions] = 1
+    return policy
+
+
+def greedyPolicy(Ts, R, discountFactor, V):
+    """ The deterministic policy that is greedy with respect to the values V. """
+    Q = _qValues(_stackedTransitions(Ts), len(Ts), R, V, discountFactor)
+    return _onehot(Q.argmax(0), len(Ts))
+
+
+def collapsedTransitions(Ts, policy):
+    """ The (sparse) transition matrix of following a (possibly stochastic) policy. """
+    res = csr_matrix(Ts[0].shape)
+    for ai, T in enumerate(Ts):
+        res = res + csr_matrix(T).multiply(policy[:, ai][:, None])
+    return csr_matrix(res)
+
+
+def policyValues(Ts, R, discountFactor, policy, tolerance=1e-6, maxIters=10000, V=None):
+    """ Iterative evaluation of a policy, returns its values and the number of sweeps. """
+    T = collapsedTransitions(Ts, policy)
+    if V is None:
+        V = zeros(len(R))
+    for i in range(maxIters):
+        Vnew = T.dot(R + discountFactor * V)
+        residual = abs(Vnew - V).max()
+        V = Vnew
+        if residual < tolerance:
+            break
+    return V, i + 1
+
+
+def valueIteration(Ts, R, discountFactor, tolerance=1e-6, maxIters=10000, verbose=False):
+    """ Synchronous (vectorized) value iteration, until the largest change of a value
+    is below the tolerance. """
+    start = time()
+    TT = _stackedTransitions(Ts)
+    R = array(R, dtype=float)
+    V = zeros(len(R))
+    residual = None
+    for i in range(maxIters):
+        Q = _qValues(TT, len(Ts), R, V, discountFactor)
+        Vnew = Q.max(0)
+        residual = abs(Vnew - V).max()
+        V = Vnew
+        if residual < tolerance:
+            break
+    policy = greedyPolicy(Ts, R, discountFactor, V)
+    stats = {'iterations': i + 1,
+             'backups': (i + 1) * len(R),
+             'residual': residual,
+             'time': time() - start}
+    if verbose:
+        print 'Value iteration:', stats
+    return V, policy, stats
+
+
+def modifiedPolicyIteration(Ts, R, discountFactor, evalSweeps=20, tolerance=1e-6, maxIters=1000,
+                            verbose=False):
+    """ Alternates greedy policy improvement with a few sweeps of (partial) policy evaluation,
+    until the policy is stable and the values have converged. """
+    start = time()
+    TT = _stackedTransitions(Ts)
+    R = array(R, dtype=float)
+    V = zeros(len(R))
+    actions = None
+    sweeps = 0
+    residual = None
+    for i in range(maxIters):
+        Q = _qValues(TT, len(Ts), R, V, discountFactor)
+        newactions = Q.argmax(0)
+        residual = abs(Q.max(0) - V).max()
+        if actions is not None and (newactions == actions).all() and residual < tolerance:
+            break
+        actions = newactions
+        V, n = policyValues(Ts, R, discountFactor, _onehot(actions, len(Ts)),
+                            tolerance=tolerance, maxIters=evalSweeps, V=V)
+        sweeps += n
+    stats = {'iterations': i + 1,
+             'backups': (i + 1 + sweeps) * len(R),
+             'residual': residual,
+             'time': time() - start}
+    if verbose:
+        print 'Modified policy iteration:', stats
+    return V, _onehot(actions, len(Ts)), stats
+
+
+def prioritizedSweeping(Ts, R, discountFactor, tolerance=1e-6, maxBackups=None, verbose=False):
+    """ Asynchronous value iteration: the state with the largest pending change is
+    backed up first, and its predecessors get re-prioritized. Efficient when
+    the values are only affected locally, e.g. by a few goal states.
+    Self-transitions (e.g. of absorbing states) are solved for exactly in each backup. """
+    start = time()
+    Ts = [csr_matrix(T) for T in Ts]
+    R = array(R, dtype=float)
+    dim = len(R)
+    if maxBackups is None:
+        maxBackups = 100 * dim
+    # predecessor lists, from the transposed union of all transitions
+    P = csr_matrix(sum(T for T in Ts).T)
+    V = zeros(dim)
+    U = R.copy()
+
+    def backup(s):
+        best = None
+        for T in Ts:
+            lo, hi = T.indptr[s], T.indptr[s + 1]
+            succs, probs = T.indices[lo:hi], T.data[lo:hi]
+            selfprob = probs[succs == s].sum()
+            q = (probs.dot(U[succs]) - selfprob * discountFactor * V[s]) / (1 - discountFactor * selfprob)
+            if best is None or q > best:
+                best = q
+        return best
+
+    # initial priorities: the full Bellman residuals
+    TT = _stackedTransitions(Ts)
+    priorities = abs(_qValues(TT, len(Ts), R, V, discountFactor).max(0) - V)
+    queue = [(-priorities[s], s) for s in (priorities >= tolerance).nonzero()[0]]
+    queue.sort()
+    backups = 0
+    while len(queue) > 0 and backups < maxBackups:
+        p, s = heappop(queue)
+        if -p != priorities[s]:
+            # outdated entry
+            continue
+        priorities[s] = 0
+        vnew = backup(s)
+        change = abs(vnew - V[s])
+        backups += 1
+        V[s] = vnew
+        U[s] = R[s] + discountFactor * vnew
+        for pred in P.indices[P.indptr[s]:P.indptr[s + 1]]:
+            # a cheap upper bound on how much the predecessor's value may change
+            bound = priorities[pred] + change * discountFactor
+            if pred != s and bound >= tolerance:
+                priorities[pred] = bound
+                heappush(queue, (-bound, pred))
+    residual = abs(_qValues(TT, len(Ts), R, V, discountFactor).max(0) - V).max()
+    policy = greedyPolicy(Ts, R, discountFactor, V)
+    stats = {'iterations': backups / float(dim),
+             'backups': backups,
+             'residual': residual,
+             'time': time() - start}
+    if verbose:
+        print 'Prioritized sweeping:', stats
+    return V, policy, stats
@@ -7,6 +7,8 @@ Managing states and observations, for different types of games
 '''
 
 import pygame
+from collections import OrderedDict
+from numpy import zeros, array
 from pybrain.utilities import setAllArgs
 
 from ontology import RotatingAvatar, BASEDIRS, GridPhysics, ShootAvatar, kill_effects
@@ -20,6 +22,8 @@ class StateObsHandler(object):
 
     A state is always composed of a tuple, with the avatar position (x,y) in the first places.
     If the avatar orientation matters, the orientation is the third element of the tuple.
+    If other sprites can die, the next element is an integer bitmask of which of them are present
+    (one bit per initial sprite position, in sorted order).
     """
 
     # is the avatar having an orientation or not?
@@ -37,6 +41,9 @@ class StateObsHandler(object):
     # can other sprites move
     staticOther = True
 
+    # how many (state, action) transitions of a deterministic game to memorize (0 = none)
+    transitionCacheSize = 0
+
     def __init__(self, game, **kwargs):
         setAllArgs(self, kwargs)
         self._game = game
@@ -89,10 +96,22 @@ class StateObsHandler(object):
             self._obscols[skey] = ss[0].color
 
         if self.mortalOther:
-            self._gravepoints = {}
+            gravepoints = set()
             for skey in self._mortal_types:
                 for s in self._game.sprite_groups[skey]:
-                    self._gravepoints[(skey, self._rect2pos(s.rect))] = True
+                    gravepoints.add((skey, self._rect2pos(s.rect)))
+            # the presences are maintained incrementally, as a bitmask with one bit per gravepoint
+            self._gravepoints = sorted(gravepoints)
+            self._gravebits = dict((gp, 1 << i) for i, gp in enumerate(self._gravepoints))
+            self._rebuildPresences()
+            game.kill_callbacks.append(self._spriteKilled)
+
+        # lookup tables for observing many states at once (built on demand)
+        self._occupancies = None
+        self._neighborOffsets = None
+
+        # memorized transitions, the least recently used first
+        self._transitions = OrderedDict()
 
     @property
     def _avatar(self):
@@ -118,7 +137,7 @@ class StateObsHandler(object):
         if not self.uniqueAvatar:
             atype = state[-1]
             if self._avatar.name != atype:
-                self._game.kill_list.append(self._avatar)
+                self._game._killSprite(self._avatar)
                 self._game._createSprite([atype], pos)
 
         if not self.uniqueAvatar:
@@ -146,35 +165,112 @@ class StateObsHandler(object):
                 return tuple(list(self._sprite2state(self._avatar))
                              + [self._avatar.name])
 
+    def _rebuildPresences(self):
+        """ Recompute the presences from the sprite groups (after the game replaced its sprites,
+        the tracked ones are gone). """
+        self._presences = 0
+        self._gravesprites = {}
+        self._spritebits = {}
+        killed = set(self._game.kill_list)
+        for skey in sorted(set(self._mortal_types)):
+            for s in self._game.sprite_groups[skey]:
+                bit = self._gravebits.get((skey, self._rect2pos(s.rect)))
+                if bit is not None and bit not in self._gravesprites and s not in killed:
+                    self._trackSprite(s, bit)
+        self._generation = self._game._sprite_generation
+
     def _getPresences(self):
-        """ Binary vector of which non-avatar sprites are present. """
-        res = []
-        for skey, pos in sorted(self._gravepoints):
-            if pos in [self._rect2pos(s.rect) for s in self._game.sprite_groups[skey]
-                       if s not in self._game.kill_list]:
-                res.append(1)
-            else:
-                res.append(0)
-        return tuple(res)
+        """ Bitmask of which non-avatar sprites are present. """
+        if self._generation != self._game._sprite_generation:
+            self._rebuildPresences()
+        return self._presences
 
     def _setPresences(self, p):
-        for i, (skey, pos) in enumerate(sorted(self._gravepoints)):
-            target = p[i] != 0
-            matches = [s for s in self._game.sprite_groups[skey] if self._rect2pos(s.rect) == pos]
-            current = (not len(matches) == 0 and matches[0] not in self._game.kill_list)
-            if current == target:
-                continue
-            elif current:
-                #print 'die', skey, pos, matches
-                self._game.kill_list.append(matches[0])
-            elif target:
-                #print 'live', skey, pos, matches
+        if self._generation != self._game._sprite_generation:
+            self._rebuildPresences()
+        changed = p ^ self._presences
+        while changed:
+            bit = changed & -changed
+            changed ^= bit
+            if self._presences & bit:
+                self._game._killSprite(self._gravesprites[bit])
+            else:
+                skey, pos = self._gravepoints[bit.bit_length() - 1]
                 pos = (pos[0] * self._game.block_size, pos[1] * self._game.block_size)
-                self._game._createSprite([skey], pos)
+                newones = self._game._createSprite([skey], pos)
+                if newones:
+                    self._trackSprite(newones[0], bit)
+
+    def _trackSprite(self, s, bit):
+        """ Let sprite s be the one responsible for a bit of the presences. """
+        old = self._gravesprites.get(bit)
+        if old is not None:
+            del self._spritebits[old]
+        self._gravesprites[bit] = s
+        self._spritebits[s] = bit
+        self._presences |= bit
+
+    def _spriteKilled(self, s):
+        bit = self._spritebits.get(s)
+        if bit is not None:
+            self._presences &= ~bit
+
+    def _useTransitionCache(self, onlyavatar=False):
+        return (self.transitionCacheSize > 0 and not self._game.is_stochastic
+                and not self.visualize and not onlyavatar)
+
+    def _performCachedAction(self, action):
+        """ In a deterministic game, the outcome of an action only depends on the state,
+        so a known transition can directly jump to the resulting state, instead of
+        simulating the game's dynamics. Subclasses provide _simulateAction. """
+        key = (self.getState(), action)
+        if key in self._transitions:
+            dest, dscore = self._transitions.pop(key)
+            self._transitions[key] = (dest, dscore)
+            self.setState(dest)
+            self._game.score += dscore
+            return
+        score = self._game.score
+        self._simulateAction(action)
+        # the state of a dead avatar cannot be set, so that one is not memorized
+        if self._avatar is not None:
+            self._transitions[key] = (self.getState(), self._game.score - score)
+            if len(self._transitions) > self.transitionCacheSize:
+                self._transitions.popitem(last=False)
 
     def _rawSensor(self, state):
         return [(state in ostates) for _, ostates in sorted(self._obstypes.items())[::-1]]
 
+    def _rawSensorBatch(self, positions):
+        """ Vectorized version of _rawSensor: for an array of positions (..., 2)
+        returns the boolean array (types, ...) of observed types. """
+        if self._occupancies is None:
+            # one grid per observed type, in the same order as _rawSensor
+            w, h = self._game.width, self._game.height
+            self._occupancies = zeros((len(self._obstypes), w, h), dtype=bool)
+            for ti, (_, ostates) in enumerate(sorted(self._obstypes.items())[::-1]):
+                for x, y in ostates:
+                    if 0 <= x < w and 0 <= y < h:
+                        self._occupancies[ti, x, y] = True
+        _, w, h = self._occupancies.shape
+        xs, ys = positions[..., 0], positions[..., 1]
+        inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        return self._occupancies[:, xs.clip(0, w - 1), ys.clip(0, h - 1)] & inside
+
+    def _stateNeighborsBatch(self, positions, orientations=None):
+        """ Vectorized version of the current position plus _stateNeighbors, for an array
+        of positions (S, 2) and of orientation indices (S), returns an array (S, 1 + neighbors, 2).
+        Assumes the neighborhood only depends on the position by translation. """
+        if self._neighborOffsets is None:
+            if self.orientedAvatar:
+                origins = [(0, 0, o) for o in BASEDIRS]
+            else:
+                origins = [(0, 0)]
+            self._neighborOffsets = array([[(0, 0)] + self._stateNeighbors(o) for o in origins])
+        if orientations is None:
+            orientations = zeros(len(positions), dtype=int)
+        return self._neighborOffsets[orientations] + positions[:, None, :]
+
     def _sprite2state(self, s, oriented=None):
         pos = self._rect2pos(s.rect)
         if oriented is None and self.orientedAvatar:
@@ -5,7 +5,6 @@ Video game description language -- utility functions.
 '''
 
 from math import sqrt
-import pygame
 
 
 def logToFile(string):
@@ -140,23 +139,20 @@ def listRotate(l, n):
 
 
 def makeGifVideo(env, actions, initstate=None, prefix='seq_', duration=0.1,
-                 outdir='../gifs/', tmpdir='../temp/'):
-    """ Generate an animated gif from a sequence of actions. """
-    from external_libs.images2gif import writeGif
-    import Image
+                 outdir='../gifs/', tmpdir=None):
+    """ Generate an animated gif from a sequence of actions, returns its file name.
+    The frames are written as they come, tmpdir is deprecated and ignored. """
+    from recording import GifRecorder
+    if tmpdir is not None:
+        import warnings
+        warnings.warn('makeGifVideo no longer writes temporary frames, tmpdir is ignored',
+                      DeprecationWarning, stacklevel=2)
     env.visualize = True
     env.reset()
     if initstate is not None:
         env.setState(initstate)
-    env._counter = 1
-    res_images = []
     astring = ''.join([str(a) for a in actions if a is not None])
-
-    def cb(*_):
-        fn = tmpdir + "tmp%05d.png" % env._counter
-        pygame.image.save(env._game.screen, fn)
-        res_images.append(Image.open(fn))
-        env._counter += 1
-
-    env.rollOut(actions, callback=cb)
-    writeGif(outdir + prefix + '%s.gif' % astring, res_images, duration=duration, dither=0)
+    recorder = GifRecorder(outdir + prefix + '%s.gif' % astring, env._game.screensize,
+                           duration=duration)
+    env.rollOut(actions, callback=lambda *_: recorder.addFrame(env._game))
+    return recorder.close()